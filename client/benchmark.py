@@ -0,0 +1,378 @@
+"""
+Micro-benchmarks for the client receive paths, and an end-to-end loopback suite.
+
+Run from the client directory, e.g.:
+    python benchmark.py udp --segments 500000
+    python benchmark.py tcp --size 200M
+    python benchmark.py loopback --sizes 1M 100M --streams 1 4 --segment-sizes 512 1400 --output results.jsonl
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import client
+import config
+from config import BUFFER_SIZE, PAYLOAD_SEGMENT_SIZE
+from utils import FinishMessenger, parse_size, payload_success_and_speed, setup_thread_logger, \
+    unpack_payload_message, set_log_level, close_logging
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KB, or None if unknown."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def blast_udp_payloads(address, segment_count, payload_size):
+    """Send segment_count payload messages to address as fast as possible."""
+    datagram = bytearray(struct.pack(">LBQQ", 0xabcddcba, 0x4, segment_count, 0) + b'X' * payload_size)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for segment_number in range(segment_count):
+            struct.pack_into(">Q", datagram, 13, segment_number)
+            sock.sendto(datagram, address)
+
+
+def legacy_receive_payloads(my_socket, logger, timeout):
+    """The original receive loop: recvfrom, full unpack, a set and per-packet debug logs."""
+    my_socket.settimeout(timeout)
+    received_segments = set()
+    total_segments = None
+    try:
+        while True:
+            data, addr = my_socket.recvfrom(BUFFER_SIZE)
+            total_segments, current_segment, _ = unpack_payload_message(data)
+            logger.debug(f"Total segments: {total_segments}")
+            logger.debug(f"Current segment: {current_segment}")
+            received_segments.add(current_segment)
+            logger.debug(f"Received segment {current_segment + 1}/{total_segments}")
+    except socket.timeout:
+        pass
+    return payload_success_and_speed(received_segments, total_segments, 1)
+
+
+def receive_in_child(path, log_level, segment_count, timeout, results):
+    """Run one receive path against a sender process and report packets/sec, dropped log records and peak RSS."""
+    set_log_level(log_level)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    with tempfile.TemporaryDirectory() as log_dir:
+        logger = setup_thread_logger(log_dir)
+        sender = multiprocessing.Process(target=blast_udp_payloads,
+                                         args=(receiver.getsockname(), segment_count, PAYLOAD_SEGMENT_SIZE))
+        start = time.perf_counter()
+        sender.start()
+        if path == "legacy":
+            success_rate, _ = legacy_receive_payloads(receiver, logger, timeout)
+            elapsed = time.perf_counter() - start - timeout  # The old loop only ends after an idle timeout
+        else:
+            messenger = FinishMessenger()
+            success_rate, _ = client.receive_payloads("127.0.0.1", 0, receiver, logger, messenger, timeout)
+            elapsed = messenger.records[0]["duration"]  # First to last packet
+        sender.join()
+        dropped = close_logging()["dropped"]
+    receiver.close()
+    received = int(round(success_rate * segment_count / 100))
+    results.put((received, received / elapsed, dropped, peak_rss_kb()))
+
+
+def bench_udp(args):
+    print(f"{'path':>8} {'logging':>8} {'received':>10} {'loss %':>7} {'packets/s':>11} {'logs dropped':>13}"
+          f" {'peak RSS KB':>12}")
+    for path in ("legacy", "fast"):
+        for log_level in ("DEBUG", "OFF"):
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(target=receive_in_child,
+                                            args=(path, log_level, args.segments, args.timeout, results))
+            child.start()
+            received, rate, dropped, rss = results.get()
+            child.join()
+            loss = 100 * (1 - received / args.segments)
+            print(f"{path:>8} {log_level.lower():>8} {received:>10} {loss:7.2f} {rate:11.0f} {dropped:>13}"
+                  f" {rss or '-':>12}")
+
+
+def serve_tcp_payload(listener):
+    """Accept one connection, read the size request and stream that many bytes back."""
+    connection, _ = listener.accept()
+    with connection:
+        size = int(connection.recv(1024).decode().strip())
+        chunk = memoryview(b'X' * 65536)
+        while size >= len(chunk):
+            connection.sendall(chunk)
+            size -= len(chunk)
+        connection.sendall(chunk[:size])
+
+
+def legacy_tcp_transfer(server_ip, server_tcp_port, thread_name, finish_messenger):
+    """The original receive loop: 4 KB recv calls with a formatted log line per chunk."""
+    logger = setup_thread_logger()
+    start_time = time.time()
+    with socket.create_connection((server_ip, server_tcp_port)) as tcp_socket:
+        tcp_socket.sendall(f"{config.FILE_SIZE}\n".encode())
+        received_bytes = 0
+        while True:
+            data = tcp_socket.recv(4096)
+            if not data:
+                break
+            received_bytes += len(data)
+            logger.info(f"Received {len(data)} bytes ({received_bytes}/{config.FILE_SIZE})")
+        transfer_time = time.time() - start_time
+        finish_messenger.tcp_finished(transfer_time, received_bytes * 8 / transfer_time)
+
+
+class RecordingMessenger(FinishMessenger):
+    """FinishMessenger that keeps the reported TCP speeds instead of printing them."""
+
+    def __init__(self):
+        super().__init__()
+        self.tcp_speeds = []
+
+    def tcp_finished(self, total_time, total_speed, **extra):
+        self.tcp_speeds.append(total_speed)
+
+
+def bench_tcp(args):
+    config.set_file_size(parse_size(args.size))
+    print(f"{'path':>8} {'logging':>8} {'Mbps':>10} {'logs dropped':>13}")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)  # Transfers write their logs under ./logs
+        for path, transfer in (("legacy", legacy_tcp_transfer), ("fast", client.handle_tcp_transfer)):
+            for log_level in ("DEBUG", "OFF"):
+                set_log_level(log_level)
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.bind(("127.0.0.1", 0))
+                listener.listen(1)
+                server_thread = threading.Thread(target=serve_tcp_payload, args=(listener,))
+                server_thread.start()
+                messenger = RecordingMessenger()
+                transfer("127.0.0.1", listener.getsockname()[1], path, messenger)
+                server_thread.join()
+                listener.close()
+                dropped = close_logging()["dropped"]
+                print(f"{path:>8} {log_level.lower():>8} {messenger.tcp_speeds[0] / 1e6:10.1f} {dropped:>13}")
+        set_log_level("DEBUG")
+        os.chdir(previous_dir)
+
+
+def free_port(kind):
+    """Return a loopback port of the given socket type that is free right now."""
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_loopback_server(mode, workers=1):
+    """
+    Start ../server/server.py on 127.0.0.1 with free ports and no offers.
+
+    Returns:
+        tuple: The server process and its (ip, UDP port, TCP port), once it accepts connections.
+    """
+    tcp_port, udp_port = free_port(socket.SOCK_STREAM), free_port(socket.SOCK_DGRAM)
+    server_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "server")
+    process = subprocess.Popen([sys.executable, "server.py", "--mode", mode, "--workers", str(workers),
+                                "--host", "127.0.0.1", "--tcp-port", str(tcp_port), "--udp-port", str(udp_port),
+                                "--no-broadcast"], cwd=server_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", tcp_port), timeout=0.2).close()
+            return process, ("127.0.0.1", udp_port, tcp_port)
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server ({mode}) did not start listening on port {tcp_port}")
+
+
+def process_tree_stats(pid):
+    """
+    CPU seconds used so far and peak RSS in KB of pid and its child processes, read from /proc.
+
+    Returns:
+        tuple: (cpu seconds, peak RSS KB), or (None, None) where /proc is not available.
+    """
+    if not os.path.isdir("/proc"):
+        return None, None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = 0.0
+    peak_rss = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()  # Fields after the command name
+            if int(entry) != pid and int(fields[1]) != pid:
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+            with open(f"/proc/{entry}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        peak_rss = max(peak_rss, int(line.split()[1]))
+        except (OSError, IndexError, ValueError):
+            continue  # The process went away while we read it
+    return cpu, peak_rss
+
+
+def run_loopback_cell(server, protocol, file_size, streams, segment_size):
+    """Run `streams` concurrent transfers of one protocol against server; return the FinishMessenger."""
+    server_ip, server_udp_port, server_tcp_port = server
+    messenger = FinishMessenger()
+    with ThreadPoolExecutor(streams) as pool:
+        for i in range(streams):
+            if protocol == "UDP":
+                pool.submit(client.handle_udp_transfer, server_ip, server_udp_port, f"UDP-{i+1}", messenger,
+                            segment_size=segment_size, file_size=file_size)
+            else:
+                pool.submit(client.handle_tcp_transfer, server_ip, server_tcp_port, f"TCP-{i+1}", messenger,
+                            file_size=file_size)
+    return messenger
+
+
+def git_revision():
+    """The short git revision of the checkout, or None."""
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def bench_loopback(args):
+    run = {"timestamp": time.time(), "revision": git_revision(), "python": platform.python_version(),
+           "platform": platform.platform()}
+    cells = [("TCP", size, streams, None) for size in args.sizes for streams in args.streams]
+    cells += [("UDP", size, streams, segment_size) for size in args.sizes for streams in args.streams
+              for segment_size in args.segment_sizes]
+    print(f"{'mode':>9} {'proto':>5} {'size':>11} {'streams':>7} {'segment':>7} {'Mbps':>9} {'packets/s':>10}"
+          f" {'loss %':>7} {'buf loss %':>10} {'CPU s/GB':>9} {'client RSS':>10} {'server RSS':>10}")
+    output = open(args.output, "a") if args.output else None
+    previous_dir = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)  # Transfers write their logs under ./logs
+            for mode in args.modes:
+                process, server = start_loopback_server(mode, args.workers)
+                try:
+                    for protocol, size, streams, segment_size in cells:
+                        for repetition in range(args.repetitions):
+                            result = measure_loopback_cell(process.pid, server, protocol, size, streams, segment_size)
+                            result.update(run, mode=mode, workers=args.workers, repetition=repetition)
+                            print_loopback_result(result)
+                            if output:
+                                output.write(json.dumps(result) + "\n")
+                                output.flush()
+                finally:
+                    process.terminate()
+                    process.wait()
+    finally:
+        os.chdir(previous_dir)
+        if output:
+            output.close()
+
+
+def measure_loopback_cell(server_pid, server, protocol, size, streams, segment_size):
+    """Run one cell and turn its transfers and the CPU used on both sides into one result record."""
+    server_cpu_before, _ = process_tree_stats(server_pid)
+    client_times_before = os.times()
+    with contextlib.redirect_stdout(io.StringIO()):  # Keep the per-transfer lines out of the table
+        messenger = run_loopback_cell(server, protocol, size, streams, segment_size)
+    client_times = os.times()
+    server_cpu, server_rss = process_tree_stats(server_pid)
+    client_cpu = (client_times.user - client_times_before.user) + (client_times.system - client_times_before.system)
+    if server_cpu is not None:
+        server_cpu -= server_cpu_before
+
+    records = [record for record in messenger.records if record["protocol"] == protocol and record["start_time"]]
+    received = sum(record["bytes"] or 0 for record in records)
+    window = max(record["end_time"] for record in records) - min(record["start_time"] for record in records) \
+        if records else 0
+    packets = sum(record["segments"] or 0 for record in records) if protocol == "UDP" else None
+    losses = [record["loss_percent"] for record in records if record["loss_percent"] is not None]
+    buffer_losses = [record["buffer_loss_percent"] for record in records if "buffer_loss_percent" in record]
+    total_cpu = client_cpu + (server_cpu or 0)
+    return {
+        "protocol": protocol,
+        "file_size": size,
+        "streams": streams,
+        "segment_size": segment_size,
+        "transfers": len(records),
+        "bytes": received,
+        "seconds": window,
+        "mbps": received * 8 / window / 1e6 if window > 0 else 0,
+        "packets_per_second": packets / window if packets is not None and window > 0 else None,
+        "loss_percent": sum(losses) / len(losses) if losses else None,
+        "buffer_loss_percent": sum(buffer_losses) / len(buffer_losses) if buffer_losses else None,
+        "socket_drops": sum(record.get("socket_drops") or 0 for record in records) if buffer_losses else None,
+        "client_cpu_s": client_cpu,
+        "server_cpu_s": server_cpu,
+        "cpu_s_per_gb": total_cpu / (received / 1e9) if received else None,
+        "client_peak_rss_kb": peak_rss_kb(),
+        "server_peak_rss_kb": server_rss,
+    }
+
+
+def print_loopback_result(result):
+    def show(value, spec):
+        return "-" if value is None else format(value, spec)
+    print(f"{result['mode']:>9} {result['protocol']:>5} {result['file_size']:>11} {result['streams']:>7}"
+          f" {show(result['segment_size'], 'd'):>7} {result['mbps']:9.1f}"
+          f" {show(result['packets_per_second'], '.0f'):>10}"
+          f" {show(result['loss_percent'], '.2f'):>7} {show(result['buffer_loss_percent'], '.2f'):>10}"
+          f" {show(result['cpu_s_per_gb'], '.2f'):>9}"
+          f" {show(result['client_peak_rss_kb'], 'd'):>10} {show(result['server_peak_rss_kb'], 'd'):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client receive-path benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    udp_parser = subparsers.add_parser("udp",
+                                       help="UDP payload receiving: packets/sec and peak RSS, old path vs fast path")
+    udp_parser.add_argument("--segments", type=int, default=500000)
+    udp_parser.add_argument("--timeout", type=float, default=0.5, help="idle timeout ending each run, in seconds")
+    udp_parser.set_defaults(func=bench_udp)
+
+    tcp_parser = subparsers.add_parser("tcp", help="TCP receiving: Mbps with logging on and off, old path vs fast path")
+    tcp_parser.add_argument("--size", default="200M", help="bytes per transfer, e.g. 200M")
+    tcp_parser.set_defaults(func=bench_tcp)
+
+    loopback_parser = subparsers.add_parser("loopback", help="End to end on 127.0.0.1 against a server subprocess:"
+                                                         " Mbps, packets/sec, CPU per GB and peak RSS")
+    loopback_parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size("10M")],
+                                 help="bytes per transfer, e.g. 1M 100M")
+    loopback_parser.add_argument("--streams", nargs="+", type=int, default=[1], help="concurrent transfers per cell")
+    loopback_parser.add_argument("--segment-sizes", nargs="+", type=int, default=[PAYLOAD_SEGMENT_SIZE],
+                                 help="UDP payload bytes per segment")
+    loopback_parser.add_argument("--modes", nargs="+", choices=("threaded", "async"), default=["threaded"])
+    loopback_parser.add_argument("--workers", type=int, default=1, help="server processes")
+    loopback_parser.add_argument("--repetitions", type=int, default=1)
+    loopback_parser.add_argument("--output", help="append one JSON line per cell to this file")
+    loopback_parser.set_defaults(func=bench_loopback)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
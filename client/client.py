@@ -1,13 +1,24 @@
+import argparse
+import json
 import socket
-import struct
 import sys
 import time
 import threading
 
-from config import BROADCAST_PORT, BUFFER_SIZE, FILE_SIZE, UDP_TIMEOUT
-from config import set_file_size
-from utils import create_udp_listener_socket, pack_udp_request, unpack_payload_message, \
-    payload_success_and_speed, setup_thread_logger, FinishMessenger
+import config
+from config import BROADCAST_PORT, BUFFER_SIZE, TCP_BUFFER_SIZE, UDP_TIMEOUT, UDP_RATE, \
+    UDP_RATE_SEARCH_STEPS, PAYLOAD_SEGMENT_SIZE, MAX_SEGMENT_SIZE, METRICS_FILE, UDP_SAMPLE_EVERY, UDP_TIMESTAMPS, \
+    UDP_GRO, GRO_BUFFER_SIZE, UDP_RELIABLE, UDP_MAX_NACK_ROUNDS, NACK_MERGE_GAP, UDP_IDLE_FACTOR, \
+    UDP_MIN_IDLE_TIMEOUT, TCP_PERSISTENT, TCP_SESSION_REQUESTS, SMALL_REQUEST_SIZE, \
+    STREAM_WORKERS, STREAM_PROCESSES, INSTRUMENT, PROFILE_FILE, LOG_LEVEL, SOCKET_BUFFER_RATE
+from config import TCP_DEST_PORT, UDP_REQUEST_PORT
+from utils import create_udp_listener_socket, pack_udp_request, payload_success_and_speed, \
+    setup_thread_logger, FinishMessenger, MetricsWriter, SegmentTracker, ProgressReporter, IntervalSampler, \
+    PacketRecorder, enable_udp_gro, gro_segment_size, PAYLOAD_HEADER, TIMESTAMP_FIELDS, TIMESTAMPED_HEADER_SIZE, \
+    parse_size, percentile, wait_until, StreamPool, DiscoveryService, unpack_offer_message, \
+    REQUEST_FLAG_TIMESTAMPS, REQUEST_FLAG_RELIABLE, pack_nack_messages, pack_tcp_request, TcpConnectionPool, \
+    timed, result_bytes, INSTRUMENTATION, set_log_level, close_logging, set_receive_buffer, \
+    open_tcp_connection, socket_buffer_stats, REJECTION_MESSAGE
 from colorama import init, Fore, Style
 
 terminate_flag = threading.Event()
@@ -33,8 +44,9 @@ def listen_for_offers():
     try:
         while not terminate_flag.is_set():
             data, addr = sock.recvfrom(BUFFER_SIZE)
-            magic_cookie, message_type, server_udp_port, tcp_port = struct.unpack(">LBHH", data[:9])
-            if magic_cookie != 0xabcddcba or message_type != 0x2:
+            try:
+                server_udp_port, tcp_port = unpack_offer_message(data)
+            except ValueError:
                 print(Fore.RED +"Invalid offer message. Ignoring.")
                 continue
             print(f"Received offer from {addr[0]}")
@@ -47,134 +59,648 @@ def listen_for_offers():
             return None, None, None
         return addr[0], server_udp_port, tcp_port
 
-def send_udp_request(server_ip, server_udp_port):
-    logger = setup_thread_logger()
+def receive_buffer_size(rate=0):
+    """SO_RCVBUF to ask for: the fixed size if one is set, else rate (bits/second, 0 = SOCKET_BUFFER_RATE) x RTT."""
+    return config.SOCKET_BUFFER_SIZE or int((rate or SOCKET_BUFFER_RATE) * config.SOCKET_BUFFER_RTT / 8)
+
+def send_udp_request(server_ip, server_udp_port, rate=UDP_RATE, timestamps=UDP_TIMESTAMPS,
+                     segment_size=PAYLOAD_SEGMENT_SIZE, reliable=UDP_RELIABLE, file_size=None, name=None):
+    if file_size is None:
+        file_size = config.FILE_SIZE
+    logger = setup_thread_logger(name=name)
     request_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    request_message = pack_udp_request(FILE_SIZE)
+    flags = (REQUEST_FLAG_TIMESTAMPS if timestamps else 0) | (REQUEST_FLAG_RELIABLE if reliable else 0)
+    request_message = pack_udp_request(file_size, rate, flags, min(segment_size, MAX_SEGMENT_SIZE))
     request_socket.bind(("", 0))
+    # Sized before the request goes out: the first burst must not overflow the default buffer
+    rcvbuf = set_receive_buffer(request_socket, receive_buffer_size(rate))
     request_socket.sendto(request_message, (server_ip, server_udp_port))
-    logger.debug(Fore.GREEN +f"Sent request for {FILE_SIZE} bytes to {server_ip} on UDP port {server_udp_port}")
+    logger.debug(Fore.GREEN +f"Sent request for {file_size} bytes to {server_ip} on UDP port {server_udp_port}"
+                 + (f" at {rate} bits/second" if rate else "") + f", receive buffer {rcvbuf} bytes")
     return request_socket, logger
 
-def receive_payloads(server_ip, server_udp_port, my_socket, logger, finish_messenger, timeout = UDP_TIMEOUT):
+def receive_payloads(server_ip, server_udp_port, my_socket, logger, finish_messenger, timeout = UDP_TIMEOUT,
+                     segment_size=PAYLOAD_SEGMENT_SIZE, gro=UDP_GRO, reliable=UDP_RELIABLE, rate=UDP_RATE):
     my_socket.settimeout(timeout)
     my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     logger.debug(Fore.BLUE +f"Receiving payloads from {server_ip}:{server_udp_port}...")
 
-    received_segments = set()
+    # One reused receive buffer, sized for one datagram or for a GRO batch of them;
+    # only the headers are unpacked, straight from it
+    gro = gro and enable_udp_gro(my_socket)
+    buffer = bytearray(GRO_BUFFER_SIZE if gro else TIMESTAMPED_HEADER_SIZE + min(segment_size, MAX_SEGMENT_SIZE))
+    buffers = [buffer]
+    counters = INSTRUMENTATION.transfer()
+    recv_into = timed(counters, "recv", my_socket.recv_into, result_bytes)
+    recvmsg_into = timed(counters, "recv", my_socket.recvmsg_into, lambda result, args: result[0])
+    gro_control_size = socket.CMSG_SPACE(4) if gro else 0
+    unpack_header = timed(counters, "unpack", PAYLOAD_HEADER.unpack_from)
+    header_size = PAYLOAD_HEADER.size
+    received_segments = None
     total_segments = None
+    received_bytes = 0
+    # Timestamped packets (type 0x5) are recorded for analysis after the transfer
+    recorder = PacketRecorder()
+    record_sequence, record_send = recorder.sequences.append, recorder.send_ns.append
+    record_receive, record_size = recorder.receive_ns.append, recorder.sizes.append
+    record_segment = recorder.segments.append
+    unpack_timestamps = timed(counters, "unpack", TIMESTAMP_FIELDS.unpack_from)
+    clock = time.perf_counter_ns
+    # The interval clock is only checked every UDP_SAMPLE_EVERY packets
+    sampler = IntervalSampler(name=logger.name)
+    maybe_sample = timed(counters, "sample", sampler.maybe_sample)
+    sample_mask = UDP_SAMPLE_EVERY - 1
+    packets = 0
+    unique_segments = 0
+    last_segment_seen = False
+    rejected = False
+    # Reliable mode: on each idle timeout, NACK what is still missing and keep receiving
+    nack_rounds = 0
+    retransmit_requested = 0
+    # The first payload (of the transfer or of a NACK round) may take up to `timeout`; after that
+    # the transfer is over once nothing arrives for UDP_IDLE_FACTOR times the longest gap seen.
+    # A paced sender goes quiet whenever it is ahead of `rate`, so a silence that comes before the
+    # segments sent so far (in order, up to the last one seen) are due at that rate is waited out too
+    idle_timeout = UDP_MIN_IDLE_TIMEOUT
+    awaiting_first = True
+    pacing_wait = False
+    first_ns = last_ns = None
+    max_gap_ns = 0
     start_time = time.time()
+    start_ns = clock()
 
     try:
         while not terminate_flag.is_set():
-            data, addr = my_socket.recvfrom(BUFFER_SIZE)
-            total_segments, current_segment, _ = unpack_payload_message(data)
-            logger.debug(f"Total segments: {total_segments}")
-            logger.debug(f"Current segment: {current_segment}")
-            received_segments.add(current_segment)
-            logger.debug(f"Received segment {current_segment + 1}/{total_segments}")
+            try:
+                if gro:
+                    nbytes, ancdata, _, _ = recvmsg_into(buffers, gro_control_size)
+                    step = gro_segment_size(ancdata) or nbytes
+                else:
+                    nbytes = step = recv_into(buffer)
+                now_ns = clock()
+                if awaiting_first:
+                    awaiting_first = False
+                    if first_ns is None:
+                        first_ns = now_ns
+                    my_socket.settimeout(idle_timeout)
+                elif now_ns - last_ns > max_gap_ns:
+                    max_gap_ns = now_ns - last_ns
+                    idle_timeout = min(timeout, max(UDP_MIN_IDLE_TIMEOUT, UDP_IDLE_FACTOR * max_gap_ns / 1e9))
+                    my_socket.settimeout(idle_timeout)
+                elif pacing_wait:
+                    my_socket.settimeout(idle_timeout)
+                pacing_wait = False
+                last_ns = now_ns
+            except socket.timeout:
+                if rate and not awaiting_first and received_segments is not None:
+                    datagram_size = segment_size + (TIMESTAMPED_HEADER_SIZE if len(recorder) else header_size)
+                    ahead = (first_ns + (current_segment + 1) * datagram_size * 8e9 / rate - clock()) / 1e9
+                    if ahead > 0:
+                        pacing_wait = True
+                        my_socket.settimeout(ahead + idle_timeout)
+                        continue
+                if not reliable or received_segments is None or nack_rounds >= UDP_MAX_NACK_ROUNDS:
+                    raise
+                ranges = received_segments.missing_ranges(NACK_MERGE_GAP)
+                if not ranges:
+                    raise
+                nack_rounds += 1
+                retransmit_requested += sum(count for _, count in ranges)
+                flags = REQUEST_FLAG_RELIABLE | (REQUEST_FLAG_TIMESTAMPS if len(recorder) else 0)
+                for message in pack_nack_messages(total_segments, segment_size, rate, flags, ranges):
+                    my_socket.sendto(message, (server_ip, server_udp_port))
+                logger.debug(Fore.CYAN +f"NACK round {nack_rounds}: requested {len(ranges)} missing ranges")
+                awaiting_first = True
+                my_socket.settimeout(timeout)
+                continue
+            # A GRO read holds several datagrams of `step` bytes (the last may be shorter)
+            for offset in range(0, nbytes, step):
+                size = min(step, nbytes - offset)
+                if size < header_size:
+                    rejected = rejected or buffer[offset:offset + size] == REJECTION_MESSAGE
+                    continue
+                magic_cookie, message_type, segment_count, current_segment = unpack_header(buffer, offset)
+                if magic_cookie != 0xabcddcba:
+                    continue
+                if message_type == 0x4:
+                    payload_size = size - header_size
+                elif message_type == 0x5 and size >= TIMESTAMPED_HEADER_SIZE:
+                    record_receive(now_ns)
+                    sequence, send_ns = unpack_timestamps(buffer, offset + header_size)
+                    payload_size = size - TIMESTAMPED_HEADER_SIZE
+                    record_sequence(sequence)
+                    record_segment(current_segment)
+                    record_send(send_ns)
+                    record_size(payload_size)
+                else:
+                    continue
+                if received_segments is None:
+                    total_segments = segment_count
+                    segment_size = payload_size
+                    received_segments = SegmentTracker(total_segments)
+                    logger.debug(f"Total segments: {total_segments}")
+                unique_segments += received_segments.add(current_segment)
+                if current_segment == total_segments - 1:
+                    last_segment_seen = True
+                received_bytes += payload_size
+                packets += 1
+                if not packets & sample_mask:
+                    maybe_sample(received_bytes, packets)
+            if rejected and received_segments is None:
+                logger.error(Fore.RED +"The server rejected the request.")
+                break
+            # Segments are sent in order, so in plain mode nothing more is coming once the last one is in
+            if received_segments is not None and (unique_segments == total_segments
+                                                  or (last_segment_seen and not reliable)):
+                logger.debug(Fore.WHITE +f"Transfer complete. {unique_segments}/{total_segments} segments received.")
+                break
     except socket.timeout:
         logger.error(Fore.WHITE +"Transfer complete. No data received for the timeout period.")
     finally:
-        end_time = time.time()
+        # Time the transfer from its first packet to its last, not to the end of the idle wait
+        # (a lone packet makes that zero, which reports no speed rather than one diluted by the wait)
+        if first_ns is not None:
+            end_time = start_time + (last_ns - start_ns) / 1e9
+            start_time += (first_ns - start_ns) / 1e9
+        else:
+            end_time = time.time()
+        sampler.finish(received_bytes, packets)
         transfer_time = end_time - start_time
-        success_rate, speed = payload_success_and_speed(received_segments, total_segments, transfer_time)
-        finish_messenger.udp_finished(transfer_time, speed, success_rate)
+        success_rate, speed = payload_success_and_speed(received_segments, total_segments, transfer_time,
+                                                        segment_size)
+        segments = len(received_segments) if received_segments else 0
+        packet_stats = None
+        if len(recorder):
+            try:
+                packet_stats = recorder.analyze(total_segments)
+            except RuntimeError as e:
+                logger.error(Fore.RED +f"Cannot analyze timestamped payloads: {e}")
+        unique_bytes = packet_stats["payload_bytes"] if packet_stats else segments * segment_size
+        reliability = {"nack_rounds": nack_rounds, "retransmit_requested": retransmit_requested} if reliable else None
+        finish_messenger.udp_finished(transfer_time, speed, success_rate, thread=logger.name,
+                                      start_time=start_time, end_time=end_time,
+                                      bytes=unique_bytes, segments=segments, total_segments=total_segments,
+                                      server=server_ip, sampler=sampler, packet_stats=packet_stats,
+                                      reliability=reliability, phases=INSTRUMENTATION.finish(counters),
+                                      socket_stats=socket_buffer_stats(my_socket, packets), rejected=rejected)
+    return success_rate, speed
 
-def handle_udp_transfer(server_ip, server_udp_port, thread_name, finish_messenger):
+def handle_udp_transfer(server_ip, server_udp_port, thread_name, finish_messenger, rate=UDP_RATE,
+                        timestamps=UDP_TIMESTAMPS, segment_size=PAYLOAD_SEGMENT_SIZE, gro=UDP_GRO,
+                        reliable=UDP_RELIABLE, file_size=None):
     request_socket = None
     try:
-        request_socket, logger = send_udp_request(server_ip, server_udp_port)
-        receive_payloads(server_ip, server_udp_port, request_socket, logger, finish_messenger)
+        request_socket, logger = send_udp_request(server_ip, server_udp_port, rate, timestamps, segment_size,
+                                                  reliable, file_size, thread_name)
+        result = receive_payloads(server_ip, server_udp_port, request_socket, logger, finish_messenger,
+                                  segment_size=segment_size, gro=gro, reliable=reliable, rate=rate)
         print(Fore.WHITE +f"Thread {thread_name} completed UDP transfer.")
+        return result
     finally:
         if request_socket:
             request_socket.close()
 
-def handle_tcp_transfer(server_ip, server_tcp_port, thread_name, finish_messenger):
-    logger = setup_thread_logger()
+def find_max_udp_rate(server_ip, server_udp_port, low_rate, high_rate, max_loss=0.0,
+                      steps=UDP_RATE_SEARCH_STEPS):
+    """
+    Ramp-up mode: binary-search the highest paced UDP rate that arrives without loss.
+
+    Each step requests a transfer paced at the midpoint of [low_rate, high_rate]
+    (bits/second) and keeps the upper half if no more than max_loss percent of
+    the segments were lost.
+
+    Returns:
+        int: The highest loss-free rate found, or 0 if even low_rate lost packets.
+    """
+    finish_messenger = FinishMessenger()
+    best_rate = 0
+    for step in range(steps):
+        rate = (low_rate + high_rate) // 2 if best_rate else low_rate
+        success_rate, _ = handle_udp_transfer(server_ip, server_udp_port, f"Rate-Search-{step+1}",
+                                              finish_messenger, rate)
+        print(Fore.CYAN +f"Rate {rate} bits/second: {success_rate:.2f}% of packets received")
+        if 100 - success_rate <= max_loss:
+            best_rate = low_rate = rate
+        elif not best_rate:
+            break  # Even the lowest rate loses packets
+        else:
+            high_rate = rate
+    return best_rate
+
+def handle_tcp_transfer(server_ip, server_tcp_port, thread_name, finish_messenger, buffer_size=TCP_BUFFER_SIZE,
+                        file_size=None):
+    if file_size is None:
+        file_size = config.FILE_SIZE
+    logger = setup_thread_logger(name=thread_name)
     logger.debug(Fore.GREEN +f"Connecting to {server_ip}:{server_tcp_port} for TCP transfer...")
+    counters = INSTRUMENTATION.transfer()
     start_time = time.time()
 
     try:
-        with socket.create_connection((server_ip, server_tcp_port)) as tcp_socket:
-            tcp_socket.sendall(f"{FILE_SIZE}\n".encode())
-            logger.debug(Fore.CYAN +f"Requested {FILE_SIZE} bytes from the server.")
+        with open_tcp_connection((server_ip, server_tcp_port), receive_buffer_size()) as tcp_socket:
+            tcp_socket.sendall(f"{file_size}\n".encode())
+            logger.debug(Fore.CYAN +f"Requested {file_size} bytes from the server.")
+            # Receive into one reused buffer; progress is logged periodically, not per chunk
+            buffer = bytearray(buffer_size)
+            recv_into = timed(counters, "recv", tcp_socket.recv_into, result_bytes)
+            progress = ProgressReporter(logger, file_size)
+            update_progress = timed(counters, "log", progress.update)
+            sampler = IntervalSampler(name=thread_name)
+            maybe_sample = timed(counters, "sample", sampler.maybe_sample)
             received_bytes = 0
             while not terminate_flag.is_set():
-                data = tcp_socket.recv(4096)
-                if not data:
+                n = recv_into(buffer)
+                if not n:
                     break
-                received_bytes += len(data)
-                logger.info(Fore.BLUE +f"Received {len(data)} bytes ({received_bytes}/{FILE_SIZE})")
+                received_bytes += n
+                update_progress(received_bytes)
+                maybe_sample(received_bytes)
             end_time = time.time()
+            sampler.finish(received_bytes)
             transfer_time = end_time - start_time
             speed = (received_bytes * 8) / transfer_time
-            finish_messenger.tcp_finished(transfer_time, speed)
+            finish_messenger.tcp_finished(transfer_time, speed, thread=thread_name, start_time=start_time,
+                                          end_time=end_time,
+                                          bytes=received_bytes, server=server_ip, sampler=sampler,
+                                          phases=INSTRUMENTATION.finish(counters),
+                                          socket_stats=socket_buffer_stats(tcp_socket))
             print(Fore.WHITE +f"Thread {thread_name} completed TCP transfer.")
     except Exception as e:
+        INSTRUMENTATION.finish(counters)
         logger.error(Fore.RED +f"Error during TCP transfer: {e}")
 
-def full_sequence(finish_messenger, udp_threads=2, tcp_threads=3):
+def handle_tcp_session(server_ip, server_tcp_port, thread_name, finish_messenger, pool,
+                       requests=TCP_SESSION_REQUESTS, buffer_size=TCP_BUFFER_SIZE, file_size=None):
+    """
+    Send `requests` session requests for file_size bytes over a pooled, persistent connection.
 
-    server_ip, server_udp_port, server_tcp_port = listen_for_offers()
-    if not server_ip or not server_udp_port:
+    No handshake is timed: each request is measured from sending it to its last
+    byte. Requests up to SMALL_REQUEST_SIZE are reported as round-trip latency,
+    larger ones as throughput, one transfer each.
+    """
+    if file_size is None:
+        file_size = config.FILE_SIZE
+    logger = setup_thread_logger(name=thread_name)
+    tcp_socket = None
+    counters = None
+    try:
+        tcp_socket = pool.acquire((server_ip, server_tcp_port))
+        logger.debug(Fore.GREEN +f"Using connection {tcp_socket.getsockname()} to {server_ip}:{server_tcp_port}")
+        buffer = bytearray(buffer_size)
+        small = file_size <= SMALL_REQUEST_SIZE
+        request = pack_tcp_request(file_size)
+        round_trips = []
+        # Small requests share one set of counters (reported with their round trips), large ones get their own
+        counters = INSTRUMENTATION.transfer() if small else None
+        for _ in range(requests):
+            if terminate_flag.is_set():
+                break
+            if not small:
+                counters = INSTRUMENTATION.transfer()
+            recv_into = timed(counters, "recv", tcp_socket.recv_into, result_bytes)
+            progress = None if small else ProgressReporter(logger, file_size)
+            sampler = None if small else IntervalSampler(name=thread_name)
+            start_time = time.time()
+            start = time.perf_counter()
+            tcp_socket.sendall(request)
+            received_bytes = 0
+            while received_bytes < file_size:
+                n = recv_into(buffer, min(buffer_size, file_size - received_bytes))
+                if not n:
+                    raise ConnectionError("Server closed the connection in the middle of a response")
+                received_bytes += n
+                if sampler:
+                    progress.update(received_bytes)
+                    sampler.maybe_sample(received_bytes)
+            transfer_time = time.perf_counter() - start
+            if small:
+                round_trips.append(transfer_time)
+                continue
+            sampler.finish(received_bytes)
+            finish_messenger.tcp_finished(transfer_time, received_bytes * 8 / transfer_time, thread=thread_name,
+                                          start_time=start_time,
+                                          end_time=start_time + transfer_time, bytes=received_bytes,
+                                          server=server_ip, sampler=sampler, phases=INSTRUMENTATION.finish(counters),
+                                          socket_stats=socket_buffer_stats(tcp_socket))
+        if round_trips:
+            finish_messenger.tcp_latency(round_trips, file_size, server_ip, INSTRUMENTATION.finish(counters),
+                                         thread_name)
+        pool.release(tcp_socket)
+        print(Fore.WHITE +f"Thread {thread_name} completed TCP session.")
+    except Exception as e:
+        INSTRUMENTATION.finish(counters)
+        logger.error(Fore.RED +f"Error during TCP session: {e}")
+        if tcp_socket:
+            pool.discard(tcp_socket)
+
+_worker_tcp_pool = None
+
+def worker_tcp_pool():
+    """The TCP connection pool of this worker process, kept for the life of the process."""
+    global _worker_tcp_pool
+    if _worker_tcp_pool is None:
+        _worker_tcp_pool = TcpConnectionPool(receive_buffer_size())
+    return _worker_tcp_pool
+
+def run_stream(protocol, server, name, file_size=None, finish_messenger=None, tcp_pool=None, persistent=False,
+               barrier=None, start_at=None):
+    """
+    Run one stream of a round on a StreamPool worker, once the round's common start is reached.
+
+    In a worker process there is no shared FinishMessenger (pass None): the stream
+    reports to one of its own, whose records are returned for the parent to merge.
+    """
+    own_messenger = finish_messenger is None
+    if own_messenger:
+        finish_messenger = FinishMessenger()
+    if persistent and tcp_pool is None:
+        tcp_pool = worker_tcp_pool()
+    server_ip, server_udp_port, server_tcp_port = server
+    if barrier is not None:
+        barrier.wait()
+    elif start_at is not None:
+        wait_until(start_at)
+
+    if protocol == "UDP":
+        handle_udp_transfer(server_ip, server_udp_port, name, finish_messenger, file_size=file_size)
+    elif tcp_pool:
+        handle_tcp_session(server_ip, server_tcp_port, name, finish_messenger, tcp_pool, file_size=file_size)
+    else:
+        handle_tcp_transfer(server_ip, server_tcp_port, name, finish_messenger, file_size=file_size)
+    if own_messenger:
+        return finish_messenger.records, finish_messenger.round_trips
+
+def full_sequence(finish_messenger, udp_threads=2, tcp_threads=3, tcp_pool=None, server=None, file_size=None,
+                  stream_pool=None, persistent=False, per_server=False):
+    """
+    Run one round of concurrent transfers.
+
+    server is a (ip, UDP port, TCP port) tuple as returned by listen_for_offers(),
+    or a list of them; without one, the round starts by waiting for an offer. With
+    several servers the streams are spread over them in turn, or with per_server
+    every server gets the full set. The streams run on stream_pool and start
+    together; without a pool, one is made for this round. In a process pool,
+    persistent makes each worker keep its own TCP connections.
+    """
+    if server is None:
+        server = listen_for_offers()
+    servers = [server] if isinstance(server, tuple) else list(server)
+    if not servers or not all(server_ip and server_udp_port for server_ip, server_udp_port, _ in servers):
         print(Fore.RED +"Failed to receive an offer. Exiting.")
         return
 
-    udp_thread_list = []
-    tcp_thread_list = []
-
-    for i in range(udp_threads):
-        name = f"UDP-Thread-{i+1}"
-        udp_thread = threading.Thread(
-            target=handle_udp_transfer,
-            args=(server_ip, server_udp_port, name, finish_messenger),
-            name=name,
-            daemon=True
-        )
-        udp_thread_list.append(udp_thread)
-        udp_thread.start()
-
-    for i in range(tcp_threads):
-        name = f"TCP-Thread-{i+1}"
-        tcp_thread = threading.Thread(
-            target=handle_tcp_transfer,
-            args=(server_ip, server_tcp_port, name, finish_messenger),
-            name=name,
-            daemon=True
-        )
-        tcp_thread_list.append(tcp_thread)
-        tcp_thread.start()
+    streams = [("UDP", f"UDP-Thread-{i+1}") for i in range(udp_threads)]
+    streams += [("TCP", f"TCP-Thread-{i+1}") for i in range(tcp_threads)]
+    if per_server:
+        streams = [(target, protocol, f"{name}@{target[0]}") for target in servers for protocol, name in streams]
+    elif len(servers) > 1:
+        streams = [(servers[i % len(servers)], protocol, f"{name}@{servers[i % len(servers)][0]}")
+                   for i, (protocol, name) in enumerate(streams)]
+    else:
+        streams = [(servers[0], protocol, name) for protocol, name in streams]
+    if not streams:
+        return
+    own_pool = stream_pool is None
+    if own_pool:
+        stream_pool = StreamPool(len(streams))
+    # Worker processes get no shared messenger or connection pool; they send their records back
+    shared_messenger = None if stream_pool.processes else finish_messenger
+    shared_tcp_pool = None if stream_pool.processes else tcp_pool
+    persistent = persistent or tcp_pool is not None
 
     try:
-        for thread in udp_thread_list:
-            thread.join()
-        for thread in tcp_thread_list:
-            thread.join()
+        barrier, start_at = stream_pool.start_signal(len(streams))
+        futures = [stream_pool.submit(run_stream, protocol, target, name, file_size, shared_messenger,
+                                      shared_tcp_pool, persistent, barrier, start_at)
+                   for target, protocol, name in streams]
+        for future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                print(Fore.RED +f"Stream failed: {e}")
+                continue
+            if result is not None:
+                finish_messenger.merge(*result)
     except KeyboardInterrupt:
         terminate_flag.set()
         print(Fore.RED +"Client terminated.")
+    finally:
+        if own_pool:
+            stream_pool.shutdown()
     if not terminate_flag.is_set():
-        print(Fore.WHITE +"All transfers complete, listening to offer requests")
+        finish_messenger.print_summary()
+        print(Fore.WHITE +"All transfers complete.")
 
 def run_client():
     fm = FinishMessenger()
     full_sequence(fm)
 
+def summarize_cell(messengers):
+    """
+    Aggregate the rounds of one batch cell.
+
+    Returns:
+        dict: Per protocol, the mean/min/max over rounds of the round's total throughput
+        (bits/second), the mean UDP loss percentage, and round-trip percentiles (ms) of
+        small TCP session requests.
+    """
+    summaries = [messenger.round_summary() for messenger in messengers]
+    cell = {}
+    for protocol in ("TCP", "UDP"):
+        totals = [summary[protocol]["sum_throughput_bps"] for summary in summaries if protocol in summary]
+        if totals:
+            cell[f"{protocol.lower()}_mean_bps"] = sum(totals) / len(totals)
+            cell[f"{protocol.lower()}_min_bps"] = min(totals)
+            cell[f"{protocol.lower()}_max_bps"] = max(totals)
+    losses = [record["loss_percent"] for messenger in messengers for record in messenger.records
+              if record["protocol"] == "UDP"]
+    if losses:
+        cell["udp_mean_loss_percent"] = sum(losses) / len(losses)
+    round_trips = sorted(rtt for messenger in messengers for rtt in messenger.round_trips)
+    if round_trips:
+        cell["rtt_p50_ms"] = percentile(round_trips, 0.50) * 1e3
+        cell["rtt_p95_ms"] = percentile(round_trips, 0.95) * 1e3
+        cell["rtt_p99_ms"] = percentile(round_trips, 0.99) * 1e3
+    # With several servers, each one's mean total throughput per protocol, for comparison
+    per_server = {}
+    for messenger in messengers:
+        for server, totals in messenger.server_summary().items():
+            for protocol, speed in totals.items():
+                per_server.setdefault(server, {}).setdefault(protocol, []).append(speed)
+    if len(per_server) > 1:
+        cell["servers"] = {server: {f"{protocol.lower()}_mean_bps": sum(speeds) / len(speeds)
+                                    for protocol, speeds in totals.items()}
+                           for server, totals in per_server.items()}
+    return cell
+
+def run_batch(server, file_sizes, tcp_counts, udp_counts, repetitions=1, metrics_writer=None, tcp_pool=None,
+              stream_pool=None, persistent=False, per_server=False):
+    """
+    Run every (file size, TCP streams, UDP streams) cell of the matrix `repetitions` times.
+
+    All rounds go to the server (or list of servers) given, so no round waits for
+    discovery, and run on the same stream_pool (see full_sequence).
+
+    Returns:
+        list: One dict per completed cell, with its parameters and summarize_cell() statistics.
+    """
+    results = []
+    for file_size in file_sizes:
+        for tcp_threads in tcp_counts:
+            for udp_threads in udp_counts:
+                messengers = []
+                for _ in range(repetitions):
+                    if terminate_flag.is_set():
+                        return results
+                    messenger = FinishMessenger(metrics_writer)
+                    full_sequence(messenger, udp_threads, tcp_threads, tcp_pool, server, file_size, stream_pool,
+                                  persistent, per_server)
+                    messengers.append(messenger)
+                cell = {"file_size": file_size, "tcp_streams": tcp_threads, "udp_streams": udp_threads,
+                        "repetitions": repetitions}
+                cell.update(summarize_cell(messengers))
+                results.append(cell)
+    return results
+
+def print_batch(results):
+    print(f"{'size':>12} {'tcp':>4} {'udp':>4} {'reps':>5} {'TCP Mbps mean/min/max':>24}"
+          f" {'UDP Mbps mean/min/max':>24} {'loss %':>7} {'RTT p50 ms':>11}")
+    for cell in results:
+        columns = []
+        for protocol in ("tcp", "udp"):
+            if f"{protocol}_mean_bps" in cell:
+                columns.append(f"{cell[f'{protocol}_mean_bps'] / 1e6:.1f}/{cell[f'{protocol}_min_bps'] / 1e6:.1f}"
+                               f"/{cell[f'{protocol}_max_bps'] / 1e6:.1f}")
+            else:
+                columns.append("-")
+        loss = f"{cell['udp_mean_loss_percent']:.2f}" if "udp_mean_loss_percent" in cell else "-"
+        rtt = f"{cell['rtt_p50_ms']:.3f}" if "rtt_p50_ms" in cell else "-"
+        print(f"{cell['file_size']:>12} {cell['tcp_streams']:>4} {cell['udp_streams']:>4} {cell['repetitions']:>5}"
+              f" {columns[0]:>24} {columns[1]:>24} {loss:>7} {rtt:>11}")
+
+def parse_server(text):
+    """Parse HOST or HOST:UDP_PORT:TCP_PORT into the tuple listen_for_offers() returns."""
+    parts = text.split(":")
+    if len(parts) == 1:
+        return parts[0], UDP_REQUEST_PORT, TCP_DEST_PORT
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError("expected HOST or HOST:UDP_PORT:TCP_PORT")
+    return parts[0], int(parts[1]), int(parts[2])
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Speed test client: runs a matrix of transfer rounds against one server")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[config.FILE_SIZE],
+                        help="bytes requested per transfer, e.g. 1M 100M")
+    parser.add_argument("--tcp", nargs="+", type=int, default=[3], help="TCP streams per round")
+    parser.add_argument("--udp", nargs="+", type=int, default=[2], help="UDP streams per round")
+    parser.add_argument("--repetitions", type=int, default=1, help="rounds per cell of the matrix")
+    parser.add_argument("--server", type=parse_server, action="append",
+                        help="HOST or HOST:UDP_PORT:TCP_PORT to test without waiting for an offer (repeatable)")
+    parser.add_argument("--servers", type=int, default=1,
+                        help="discovered servers to test at once (0 = every live server)")
+    parser.add_argument("--per-server", action="store_true",
+                        help="give every server the full set of streams instead of spreading them")
+    parser.add_argument("--forever", action="store_true", help="repeat the whole matrix until interrupted")
+    parser.add_argument("--json", help="write the aggregated results to this file")
+    parser.add_argument("--metrics", default=METRICS_FILE, help="append per-transfer records to this file")
+    parser.add_argument("--persistent", action="store_true", default=TCP_PERSISTENT,
+                        help="reuse TCP connections across rounds (session requests)")
+    parser.add_argument("--workers", type=int, default=STREAM_WORKERS,
+                        help="stream pool size (default: the most streams any round has)")
+    parser.add_argument("--processes", action="store_true", default=STREAM_PROCESSES,
+                        help="run streams in worker processes instead of threads")
+    parser.add_argument("--instrument", action="store_true", default=INSTRUMENT,
+                        help="count calls, bytes and time per phase of every transfer (recv, unpack, log, sample)")
+    parser.add_argument("--profile", default=PROFILE_FILE, help="cProfile the first transfer into this file")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR", "OFF"), default=LOG_LEVEL,
+                        help="lowest level written to the per-thread log files")
+    parser.add_argument("--find-rate", nargs=2, type=int, metavar=("LOW", "HIGH"),
+                        help="ramp-up mode: search the highest loss-free UDP rate (bits/second) between LOW and HIGH"
+                             " against the first server, instead of running the matrix")
+    parser.add_argument("--max-loss", type=float, default=0.0,
+                        help="loss percentage --find-rate still counts as loss-free")
+    parser.add_argument("--rtt", type=float, default=config.SOCKET_BUFFER_RTT,
+                        help="round-trip time (seconds) kernel receive buffers are sized for")
+    parser.add_argument("--socket-buffer", type=parse_size, default=config.SOCKET_BUFFER_SIZE,
+                        help="fixed kernel receive buffer size instead of sizing from rate and RTT (0 = auto)")
+    return parser.parse_args()
+
+def choose_servers(discovery, count):
+    """The servers for the next matrix: count of the live ones (0 = all), waiting for offers if needed."""
+    servers = discovery.wait_for_servers(max(count, 1))
+    if count and len(servers) < count:
+        print(Fore.RED +f"Only {len(servers)} of {count} servers discovered.")
+    return servers[:count] if count else servers
+
+def fit_servers(servers, streams_per_server, workers):
+    """The servers a --per-server round fits on the stream pool, warning about any left out."""
+    if not streams_per_server:
+        return servers
+    fit = max(1, workers // streams_per_server)
+    if len(servers) > fit:
+        print(Fore.RED +f"{len(servers)} servers discovered, but {workers} workers run {streams_per_server} streams"
+                        f" for only {fit} of them; testing the first {fit}.")
+    return servers[:fit]
+
 if __name__ == "__main__":
-    tcp_connections = input("Enter the number of TCP connections: ")
-    udp_connections = input("Enter the number of UDP connections: ")
-    file_size = input("Enter the file size (in bytes): ")
-    set_file_size(int(file_size))
+    args = parse_args()
+    INSTRUMENTATION.configure(args.instrument, args.profile)  # Before the stream pool, so workers inherit it
+    set_log_level(args.log_level)
+    config.set_socket_buffers(args.rtt, args.socket_buffer)
+    discovery = None if args.server else DiscoveryService().start()
+    servers = args.server or choose_servers(discovery, args.servers)
+    if not servers:
+        print(Fore.RED +"Failed to receive an offer. Exiting.")
+        sys.exit(1)
+    metrics_writer = MetricsWriter(args.metrics) if args.metrics else None
+    tcp_pool = TcpConnectionPool(receive_buffer_size()) if args.persistent and not args.processes else None
+    streams = max(args.tcp) + max(args.udp)
+    if args.per_server:
+        streams *= max(len(servers), args.servers)
+    if args.workers and args.workers < streams:
+        # Every stream of a round starts at once, so the pool needs a worker for each
+        print(Fore.RED +f"--workers {args.workers} is too few: the largest round runs {streams} streams at once."
+                        f" Use --workers {streams} or more, or 0 for one worker per stream.")
+        sys.exit(2)
+    stream_pool = StreamPool(args.workers or streams, args.processes)
 
     try:
-        while not terminate_flag.is_set():
-            fm = FinishMessenger()
-            full_sequence(fm, int(udp_connections), int(tcp_connections))
+        if args.find_rate:
+            config.set_file_size(args.sizes[0])
+            server_ip, server_udp_port, _ = servers[0]
+            best_rate = find_max_udp_rate(server_ip, server_udp_port, *args.find_rate, max_loss=args.max_loss)
+            if best_rate:
+                print(Fore.GREEN +f"Highest UDP rate with at most {args.max_loss}% loss: {best_rate} bits/second")
+            else:
+                print(Fore.RED +f"Even {args.find_rate[0]} bits/second lost more than {args.max_loss}% of packets.")
+        while not args.find_rate and not terminate_flag.is_set():
+            results = run_batch(servers, args.sizes, args.tcp, args.udp, args.repetitions, metrics_writer, tcp_pool,
+                                stream_pool, args.persistent, args.per_server)
+            print_batch(results)
+            if args.json:
+                with open(args.json, "w") as out:
+                    json.dump(results, out, indent=2)
+            if not args.forever:
+                break
+            if discovery:
+                servers = choose_servers(discovery, args.servers) or servers  # Pick up servers that came and went
+                if args.per_server:
+                    servers = fit_servers(servers, max(args.tcp) + max(args.udp), stream_pool.workers)
     except KeyboardInterrupt:
         terminate_flag.set()
         print(Fore.RED +"Client stopped at main.")
+    finally:
+        stream_pool.shutdown()
+        if discovery:
+            discovery.stop()
+        if tcp_pool:
+            tcp_pool.close()
+        if metrics_writer:
+            metrics_writer.close()
+        log_stats = close_logging()
+        if log_stats and log_stats["dropped"]:
+            print(Fore.RED +f"Logging fell behind: {log_stats['dropped']} log records were dropped.")
 
     # Create two threads for running two clients
 
@@ -1,15 +1,60 @@
 # UDP Configuration
 TCP_DEST_PORT = 4000           # Port for TCP requests
 BROADCAST_PORT = 5000  # Port to listen for broadcast messages
-UDP_REQUEST_PORT = 7000           # Port for UDP requests
-BUFFER_SIZE = 1024     # Size of the buffer for receiving UDP data
+UDP_REQUEST_PORT = 6000           # Port for UDP requests (the server's UDP_REQUEST_PORT)
+BUFFER_SIZE = 1024     # Size of the buffer for receiving offer messages
+TCP_BUFFER_SIZE = 1048576      # Size of the reused buffer for receiving TCP data
+PROGRESS_INTERVAL = 1.0        # Seconds between progress log lines during a transfer
+TCP_PERSISTENT = False         # Reuse TCP connections across rounds (session requests)
+TCP_SESSION_REQUESTS = 1       # Session requests per TCP thread per round
+SMALL_REQUEST_SIZE = 65536     # Session requests up to this size report latency, not throughput
 FILE_SIZE = 1048576      # Size of the file to request from the server
 SERVER_IP = None
-PAYLOAD_SEGMENT_SIZE = 512
-UDP_TIMEOUT = 1
+OFFER_EXPIRY = 5               # Seconds without an offer before a discovered server is forgotten
+DISCOVERY_TIMEOUT = 10         # Seconds to wait for enough servers to be discovered
+PAYLOAD_SEGMENT_SIZE = 512     # Payload bytes per UDP segment to request
+MAX_SEGMENT_SIZE = 65470       # Largest segment the server accepts (UDP limit minus header)
+UDP_GRO = False                # Let the kernel coalesce received segments (Linux UDP GRO)
+GRO_BUFFER_SIZE = 65536        # Receive buffer size with GRO, enough for one coalesced batch
+# Kernel receive buffers are sized rate x RTT, capped by rmem_max, unless SOCKET_BUFFER_SIZE is set
+SOCKET_BUFFER_RTT = 0.05       # Round-trip time in seconds
+SOCKET_BUFFER_RATE = 1000000000  # Rate in bits/second when no UDP rate is requested
+SOCKET_BUFFER_SIZE = 0         # Fixed size in bytes (0 = auto)
+UDP_TIMEOUT = 1                # Seconds to wait for the first payload, and for resends after a NACK
+UDP_IDLE_FACTOR = 4            # Once data flows, a silence this many times the longest gap ends it
+UDP_MIN_IDLE_TIMEOUT = 0.05    # Lower bound for that adaptive idle timeout, in seconds
+METRICS_FILE = None    # JSON Lines (or .csv) file for per-transfer records (None = off)
+INTERVAL_MS = 100              # Milliseconds between throughput samples during a transfer
+INTERVAL_SAMPLES = 600         # Samples kept per transfer (a ring buffer)
+UDP_SAMPLE_EVERY = 64          # UDP packets between interval clock checks (power of two)
+LIVE_INTERVALS = False         # Print every interval sample to the console while transfers run
+LOG_LEVEL = "DEBUG"            # Lowest level written to the logs/ files ("OFF" = no logging)
+LOG_QUEUE_SIZE = 10000         # Records waiting for the log writer; more are dropped and counted
+LOG_MAX_BYTES = 10485760       # Size at which a thread's log file is rotated
+LOG_BACKUPS = 3                # Rotated log files kept per thread
+UDP_RATE = 0           # UDP rate to request, in bits/second (0 = server default)
+UDP_RATE_SEARCH_STEPS = 8      # Paced transfers made by --find-rate
+UDP_TIMESTAMPS = False         # Timestamped payloads: delay, jitter, reordering (needs numpy)
+UDP_RELIABLE = False           # NACK missing segments until all have arrived
+UDP_MAX_NACK_ROUNDS = 10       # Give up on a reliable transfer after this many NACK rounds
+NACK_MAX_RANGES = 80           # Missing ranges per NACK, within the server's 1024-byte read
+NACK_MERGE_GAP = 4             # Merge missing ranges at most this many segments apart
+STREAM_WORKERS = 0             # Stream pool size (0 = the most streams any round has)
+STREAM_PROCESSES = False       # Run streams in processes, to use more than one core
+STREAM_START_DELAY = 0.25      # Seconds from handing a round to processes to its start
+STREAM_START_TIMEOUT = 10      # Seconds streams wait at the start barrier before giving up
+INSTRUMENT = False             # Count calls, bytes and time per transfer phase
+PROFILE_FILE = None            # cProfile the first transfer into this file (None = off)
 TCP_CONNECTIONS = None
 UDP_CONNECTIONS = None
 
 def set_file_size(file_size):
     global FILE_SIZE
     FILE_SIZE = file_size
+
+def set_socket_buffers(rtt=None, size=None):
+    global SOCKET_BUFFER_RTT, SOCKET_BUFFER_SIZE
+    if rtt is not None:
+        SOCKET_BUFFER_RTT = rtt
+    if size is not None:
+        SOCKET_BUFFER_SIZE = size
@@ -1,11 +1,63 @@
+import cProfile
 import socket
 import time
 import struct
 import logging
+import logging.handlers
+import multiprocessing.util
 from threading import current_thread
 import threading
 import os
-from config import PAYLOAD_SEGMENT_SIZE
+import csv
+import json
+import queue
+import re
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import PAYLOAD_SEGMENT_SIZE, PROGRESS_INTERVAL, INTERVAL_MS, INTERVAL_SAMPLES, LIVE_INTERVALS, \
+    NACK_MAX_RANGES, STREAM_START_DELAY, STREAM_START_TIMEOUT, BROADCAST_PORT, BUFFER_SIZE, OFFER_EXPIRY, \
+    DISCOVERY_TIMEOUT, LOG_QUEUE_SIZE, LOG_MAX_BYTES, LOG_BACKUPS
+
+try:
+    import numpy as np  # Only needed to analyze timestamped transfers
+except ImportError:
+    np = None
+
+# Offer message: magic cookie, type, server UDP port, server TCP port
+OFFER_MESSAGE = struct.Struct(">LBHH")
+# Payload message header: magic cookie, type, total segments, current segment
+PAYLOAD_HEADER = struct.Struct(">LBQQ")
+# Timestamped payload messages (type 0x5) add a sequence number and the server's send time (ns)
+TIMESTAMP_FIELDS = struct.Struct(">QQ")
+TIMESTAMPED_HEADER_SIZE = PAYLOAD_HEADER.size + TIMESTAMP_FIELDS.size
+REQUEST_FLAG_TIMESTAMPS = 0x1
+REQUEST_FLAG_RELIABLE = 0x2
+
+# NACK message (type 0x6): magic cookie, type, total segments, segment size, rate, flags, range count,
+# then (first segment, segment count) per missing range
+NACK_HEADER = struct.Struct(">LBQIQBH")
+NACK_RANGE = struct.Struct(">QI")
+# TCP session request (type 0x7): magic cookie, type, requested size
+TCP_REQUEST = struct.Struct(">LBQ")
+# What the server sends instead of payloads when it does not admit a UDP request (type 0x8)
+REJECTION_MESSAGE = struct.pack(">LB", 0xabcddcba, 0x8)
+# Bitmap bytes that hold missing segments: runs of empty bytes, or single partly filled bytes
+MISSING_BYTES = re.compile(rb"\x00+|[^\x00\xff]")
+
+# Linux UDP generic receive offload: the kernel hands over several datagrams in one read
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+GRO_SIZE = struct.Struct("=i")
+
+# The kernel clamps SO_RCVBUF requests to rmem_max without saying so; the third field of
+# tcp_rmem is how far TCP autotuning grows a receive window unaided
+RMEM_MAX_FILE = "/proc/sys/net/core/rmem_max"
+TCP_RMEM_FILE = "/proc/sys/net/ipv4/tcp_rmem"
+# Linux reports back twice the SO_RCVBUF that was set, the extra half being its bookkeeping
+RCVBUF_REPORT_FACTOR = 2 if sys.platform.startswith("linux") else 1
+# Per-socket UDP tables; the last column counts datagrams dropped because the receive buffer was full
+UDP_SOCKET_TABLES = ("/proc/net/udp", "/proc/net/udp6")
+
 def create_udp_listener_socket(port):
     """
     Create and return a UDP socket for listening to broadcasts.
@@ -15,13 +67,97 @@ def create_udp_listener_socket(port):
     sock.bind(("", port))  # Bind to all available network interfaces
     return sock
 
+def unpack_offer_message(data):
+    """
+    Unpack an offer message broadcast by a server and validate it.
+
+    Returns:
+        tuple: The server's UDP and TCP request ports.
+    """
+    if len(data) < OFFER_MESSAGE.size:
+        raise ValueError("Offer message too short")
+    magic_cookie, message_type, udp_port, tcp_port = OFFER_MESSAGE.unpack_from(data)
+    if magic_cookie != 0xabcddcba or message_type != 0x2:
+        raise ValueError("Invalid magic cookie or message type")
+    return udp_port, tcp_port
+
+class DiscoveryService:
+    """
+    Cache of live servers, kept up to date from their broadcast offers on a background thread.
+
+    Each offer refreshes its server's last-seen time, and servers not heard from for
+    `expiry` seconds drop out, so rounds can start from the cache instead of waiting
+    for the next broadcast. Servers are (ip, UDP port, TCP port) tuples, as returned
+    by listen_for_offers().
+    """
+
+    def __init__(self, port=BROADCAST_PORT, expiry=OFFER_EXPIRY):
+        self.port = port
+        self.expiry = expiry
+        self.last_seen = {}
+        self.changed = threading.Condition()
+        self.stop_event = threading.Event()
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        self.sock = create_udp_listener_socket(self.port)
+        self.sock.settimeout(0.5)  # Check for stop() twice a second
+        self.thread = threading.Thread(target=self._listen, name="Discovery", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.sock:
+            self.sock.close()
+
+    def wait_for_servers(self, count=1, timeout=DISCOVERY_TIMEOUT):
+        """Wait until at least count servers are live; return the live servers (possibly fewer on timeout)."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                live = self._live()
+                remaining = deadline - time.monotonic()
+                if len(live) >= count or remaining <= 0 or self.stop_event.is_set():
+                    return live
+                self.changed.wait(min(remaining, self.expiry))
+
+    def _live(self):
+        now = time.monotonic()
+        for server, seen in list(self.last_seen.items()):
+            if now - seen > self.expiry:
+                del self.last_seen[server]
+        return sorted(self.last_seen, key=self.last_seen.get, reverse=True)
+
+    def _listen(self):
+        while not self.stop_event.is_set():
+            try:
+                data, address = self.sock.recvfrom(BUFFER_SIZE)
+                udp_port, tcp_port = unpack_offer_message(data)
+            except socket.timeout:
+                continue
+            except ValueError:
+                continue  # Not an offer
+            except OSError:
+                break
+            server = (address[0], udp_port, tcp_port)
+            with self.changed:
+                new = server not in self.last_seen
+                self.last_seen[server] = time.monotonic()
+                self.changed.notify_all()
+            if new:
+                print(f"Discovered server {address[0]} (UDP port {udp_port}, TCP port {tcp_port})")
+
 def log_message(message):
     """
     Log a message with a timestamp.
     """
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}")
 
-def pack_udp_request(file_size):
+def pack_udp_request(file_size, rate=0, flags=0, segment_size=0):
     """
     Pack a UDP request message into the specified binary format.
 
@@ -29,12 +165,203 @@ def pack_udp_request(file_size):
     - Magic cookie (4 bytes): 0xabcddcba
     - Message type (1 byte): 0x3 (request)
     - File size (8 bytes): The requested file size, in bytes.
+    Optional fields, sent only when they (or a later field) are set:
+    - Rate (8 bytes): The requested sending rate, in bits/second (0 = server default).
+    - Flags (1 byte): REQUEST_FLAG_* bits.
+    - Segment size (4 bytes): The requested payload bytes per segment (0 = server default).
     """
     magic_cookie = 0xabcddcba
     message_type = 0x3
 
+    # The optional fields are positional, so send them up to the last one that is set
+    options = [("Q", rate), ("B", flags), ("I", segment_size)]
+    while options and not options[-1][1]:
+        options.pop()
+
     # Pack the data into a binary format
-    return struct.pack(">LBQ", magic_cookie, message_type, file_size)
+    return struct.pack(">LBQ" + "".join(code for code, _ in options),
+                       magic_cookie, message_type, file_size, *(value for _, value in options))
+
+def pack_nack_messages(total_segments, segment_size, rate, flags, ranges, max_ranges=NACK_MAX_RANGES):
+    """
+    Pack NACK messages asking the server to resend the given segment ranges.
+
+    Each message repeats the transfer parameters so the server can resend without
+    keeping any state, and carries at most max_ranges (first, count) ranges.
+
+    Returns:
+        list: The packed messages, one datagram each.
+    """
+    messages = []
+    for start in range(0, len(ranges), max_ranges):
+        batch = ranges[start:start + max_ranges]
+        message = bytearray(NACK_HEADER.size + len(batch) * NACK_RANGE.size)
+        NACK_HEADER.pack_into(message, 0, 0xabcddcba, 0x6, total_segments, segment_size, rate, flags, len(batch))
+        for i, (first, count) in enumerate(batch):
+            NACK_RANGE.pack_into(message, NACK_HEADER.size + i * NACK_RANGE.size, first, count)
+        messages.append(message)
+    return messages
+
+def pack_tcp_request(size):
+    """Pack a TCP session request for size bytes; the server answers with exactly that many."""
+    return TCP_REQUEST.pack(0xabcddcba, 0x7, size)
+
+class TcpConnectionPool:
+    """
+    Idle TCP session connections per server address, kept open across rounds.
+
+    acquire() hands out an idle connection (or opens a new one) and release()
+    returns it; a connection the server has closed in the meantime is dropped.
+    """
+
+    def __init__(self, buffer_size=0):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.buffer_size = buffer_size  # Receive buffer asked for on new connections (0 = kernel default)
+
+    def acquire(self, address):
+        with self.lock:
+            connections = self.idle.get(address, [])
+            while connections:
+                sock = connections.pop()
+                if self._is_open(sock):
+                    return sock
+                sock.close()
+        sock = open_tcp_connection(address, self.buffer_size)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Requests are small; send them right away
+        return sock
+
+    def release(self, sock):
+        with self.lock:
+            self.idle.setdefault(sock.getpeername(), []).append(sock)
+
+    def discard(self, sock):
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for sock in connections:
+                    sock.close()
+            self.idle.clear()
+
+    @staticmethod
+    def _is_open(sock):
+        """An idle session connection has nothing to read; EOF or stray data means it is unusable."""
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.setblocking(True)
+
+def enable_udp_gro(sock):
+    """
+    Turn on UDP GRO for sock where the platform supports it.
+
+    Returns:
+        bool: Whether GRO is on; reads may then return several datagrams at once.
+    """
+    if not hasattr(socket, "SOL_UDP") or not hasattr(socket, "CMSG_SPACE"):
+        return False
+    try:
+        sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+def gro_segment_size(ancdata):
+    """Return the datagram size of a GRO-coalesced read from its control messages, or 0."""
+    for level, kind, data in ancdata:
+        if level == socket.SOL_UDP and kind == UDP_GRO and len(data) >= GRO_SIZE.size:
+            return GRO_SIZE.unpack_from(data)[0]
+    return 0
+
+def read_proc_value(path, field=0):
+    """The field-th number in a /proc/sys file, or None off Linux or when it cannot be read."""
+    try:
+        with open(path) as f:
+            return int(f.read().split()[field])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def set_receive_buffer(sock, wanted, tcp=False):
+    """
+    Raise sock's SO_RCVBUF towards wanted bytes, no further than rmem_max allows.
+
+    On a TCP socket the request is skipped when tcp_rmem autotuning reaches wanted on its
+    own, because a fixed SO_RCVBUF pins the advertised window for the whole connection.
+
+    Returns:
+        int: SO_RCVBUF as the kernel reports it, twice the bytes set on Linux.
+    """
+    limit = read_proc_value(RMEM_MAX_FILE)
+    if limit is not None:
+        wanted = min(wanted, limit)
+    autotune = read_proc_value(TCP_RMEM_FILE, 2) if tcp else None
+    current = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // RCVBUF_REPORT_FACTOR
+    if wanted > current and (autotune is None or wanted > autotune):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+def open_tcp_connection(address, buffer_size=0):
+    """
+    Connect to address like socket.create_connection, sizing the receive buffer first.
+
+    The buffer has to be set before the handshake, which fixes the window scale.
+    """
+    family, sock_type, proto, _, sockaddr = socket.getaddrinfo(*address, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, sock_type, proto)
+    try:
+        if buffer_size:
+            set_receive_buffer(sock, buffer_size, tcp=True)
+        sock.connect(sockaddr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def udp_socket_drops(sock):
+    """
+    Datagrams the kernel dropped for sock because its receive buffer was full.
+
+    Read from /proc/net/udp once a transfer is over, so the receive loop pays nothing for it.
+
+    Returns:
+        int: The drop count, or None where the table is not available.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in UDP_SOCKET_TABLES:
+        try:
+            with open(path) as table:
+                next(table, None)  # Column headings
+                for line in table:
+                    fields = line.split()
+                    if len(fields) > 9 and fields[9] == inode:
+                        return int(fields[-1])
+        except (OSError, ValueError):
+            continue
+    return None
+
+def socket_buffer_stats(sock, datagrams=0):
+    """
+    The effective receive buffer of a finished transfer's socket and, for UDP, the kernel's drops.
+
+    datagrams is how many payload datagrams the transfer read. buffer_loss_percent is the
+    share of those that reached the host (read plus dropped) but found the buffer full;
+    it counts retransmitted copies too, so it does not add up with loss_percent.
+    """
+    stats = {"rcvbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)}
+    if sock.type == socket.SOCK_DGRAM:
+        drops = udp_socket_drops(sock)
+        if drops is not None:
+            stats["socket_drops"] = drops
+            stats["buffer_loss_percent"] = drops * 100 / (datagrams + drops) if drops else 0.0
+    return stats
 
 
 def unpack_payload_message(data):
@@ -66,79 +393,829 @@ def unpack_payload_message(data):
 
     return total_segments, current_segment, payload_data
 
-def payload_success_and_speed(received_segments, total_segments, trans_time):
+class SegmentTracker:
+    """
+    Bitmap of received segment numbers, one bit per segment of the transfer.
+
+    Uses total_segments / 8 bytes however many packets arrive, and len() gives
+    the number of distinct segments received, like a set of segment numbers.
+    """
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.bitmap = bytearray((total_segments + 7) // 8)
+
+    def add(self, segment):
+        """Mark segment as received; return True if it had not been received before."""
+        if segment >= self.total_segments:
+            return False
+        bit = 1 << (segment & 7)
+        byte = self.bitmap[segment >> 3]
+        if byte & bit:
+            return False
+        self.bitmap[segment >> 3] = byte | bit
+        return True
+
+    def __len__(self):
+        return bin(int.from_bytes(self.bitmap, "little")).count("1")
+
+    def missing_ranges(self, merge_gap=0):
+        """
+        Return the segments not received yet as a list of (first, count) ranges.
+
+        Empty bitmap bytes are taken eight segments at a time; only partly filled
+        bytes are checked bit by bit. Ranges separated by at most merge_gap received
+        segments are merged, trading a few duplicates for fewer ranges.
+        """
+        ranges = []
+
+        def extend(first, end):
+            if ranges and first - (ranges[-1][0] + ranges[-1][1]) <= merge_gap:
+                ranges[-1][1] = end - ranges[-1][0]
+            else:
+                ranges.append([first, end - first])
+
+        for match in MISSING_BYTES.finditer(self.bitmap):
+            start, end = match.span()
+            if self.bitmap[start] == 0:
+                extend(start * 8, min(end * 8, self.total_segments))
+                continue
+            byte = self.bitmap[start]
+            for bit in range(8):
+                segment = start * 8 + bit
+                if segment < self.total_segments and not byte & (1 << bit):
+                    extend(segment, segment + 1)
+        return [(first, count) for first, count in ranges if count > 0]
+
+def payload_success_and_speed(received_segments, total_segments, trans_time, segment_size=PAYLOAD_SEGMENT_SIZE):
     """
     Calculate the success rate of received segments.
 
     Args:
-        received_segments (set): Set of received segment numbers.
+        received_segments (SegmentTracker or set): The received segment numbers.
         total_segments (int): Total number of segments.
         trans_time (float): Total transfer time, in seconds.
+        segment_size (int): Payload bytes per segment, as received.
     Returns:
         float: Percentage of successfully received packets.
     """
     if (not total_segments or not received_segments):
         return 0, 0
     success_rate = (len(received_segments) / total_segments) * 100
-    speed = (len(received_segments) * PAYLOAD_SEGMENT_SIZE * 8) / trans_time
+    speed = (len(received_segments) * segment_size * 8) / trans_time if trans_time > 0 else 0
     return success_rate, speed
 
-def setup_thread_logger(log_dir="logs"):
+class PacketRecorder:
     """
-    Set up a thread-specific logger that logs to a unique file for the current thread.
+    Per-packet record of a timestamped UDP transfer, in arrival order.
 
-    Returns:
-        logging.Logger: Thread-specific logger instance.
+    The receive loop appends to the arrays directly; analyze() turns them into
+    NumPy arrays once the transfer is over.
+    """
+
+    def __init__(self):
+        self.sequences = array("q")
+        self.segments = array("q")
+        self.send_ns = array("q")
+        self.receive_ns = array("q")
+        self.sizes = array("q")
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def analyze(self, total_segments=None):
+        """
+        Compute delay, jitter, reordering and duplicate statistics.
+
+        - Relative one-way delay: transit time (receive - send) above the smallest one seen,
+          since the two hosts' clocks are not synchronized.
+        - Jitter: the RFC 3550 interarrival jitter estimate (J += (|D| - J) / 16), evaluated
+          in closed form as an exponentially weighted sum of |D|.
+        - Reordering: a packet is reordered if one sent after it (higher sequence number)
+          arrived before it; its depth is the distance to the highest sequence number seen
+          so far. Retransmissions (sequence numbers from total_segments up) are left out.
+        - Duplicates: packets whose segment had already arrived.
+
+        Returns:
+            dict: The statistics, with delays in milliseconds and payload bytes of the
+            distinct segments received.
+        """
+        if np is None:
+            raise RuntimeError("numpy is required to analyze timestamped transfers")
+        if not self.sequences:
+            return {}
+        sequences = np.frombuffer(self.sequences, dtype=np.int64)
+        segments = np.frombuffer(self.segments, dtype=np.int64)
+        transit = np.frombuffer(self.receive_ns, dtype=np.int64) - np.frombuffer(self.send_ns, dtype=np.int64)
+        sizes = np.frombuffer(self.sizes, dtype=np.int64)
+
+        unique_segments, first_index = np.unique(segments, return_index=True)
+        delay_ms = (transit - transit.min()) / 1e6
+
+        # Duplicates are counted separately, so only first arrivals of the first pass can be reordered
+        counted = np.zeros(len(sequences), dtype=bool)
+        counted[first_index] = True
+        if total_segments is not None:
+            counted &= sequences < total_segments
+        depth = np.zeros(len(sequences), dtype=np.int64)
+        original = sequences[counted]
+        if len(original) > 1:
+            highest_before = np.maximum.accumulate(original)[:-1]
+            depth[np.flatnonzero(counted)[1:]] = np.maximum(highest_before - original[1:], 0)
+
+        differences = np.abs(np.diff(transit)) / 1e6
+        if len(differences):
+            weights = (15 / 16) ** np.arange(len(differences) - 1, -1, -1) / 16
+            jitter_ms = float(np.dot(weights, differences))
+        else:
+            jitter_ms = 0.0
+
+        return {
+            "payload_bytes": int(sizes[first_index].sum()),
+            "duplicates": int(len(segments) - len(unique_segments)),
+            "reordered": int(np.count_nonzero(depth)),
+            "max_reorder_depth": int(depth.max()),
+            "delay_mean_ms": float(delay_ms.mean()),
+            "delay_max_ms": float(delay_ms.max()),
+            "jitter_ms": jitter_ms,
+        }
+
+class ProgressReporter:
+    """
+    Log transfer progress at most once every interval seconds.
+
+    Replaces per-chunk logging in receive loops; update() only reads the clock
+    unless a report is due.
+    """
+
+    def __init__(self, logger, total, interval=PROGRESS_INTERVAL):
+        self.logger = logger
+        self.total = total
+        self.interval = interval
+        self.next_report = time.monotonic() + interval
+
+    def update(self, done):
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.logger.info(f"Received {done}/{self.total} bytes")
+
+class IntervalSampler:
+    """
+    iperf-style interval sampling of one transfer.
+
+    Every interval_ms the receive loop hands over its cumulative byte and segment
+    counts, which are stored with a perf_counter_ns timestamp in preallocated ring
+    buffers of `capacity` samples. The receive loop decides how often to call
+    maybe_sample(); nothing here runs per packet.
     """
 
-    thread_name = current_thread().name
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)  # Ensure the log directory exists
+    def __init__(self, interval_ms=INTERVAL_MS, capacity=INTERVAL_SAMPLES, live=LIVE_INTERVALS, name=None):
+        self.interval_ns = int(interval_ms * 1_000_000)
+        self.capacity = capacity
+        self.live = live
+        self.name = name  # Stream name for live output
+        self.times = array("q", bytes(8 * capacity))
+        self.bytes = array("q", bytes(8 * capacity))
+        self.segments = array("q", bytes(8 * capacity))
+        self.count = 0
+        self.start_ns = time.perf_counter_ns()
+        self.next_sample_ns = self.start_ns + self.interval_ns
+        self._store(self.start_ns, 0, 0)
+
+    def _store(self, now_ns, total_bytes, total_segments):
+        index = self.count % self.capacity
+        self.times[index] = now_ns
+        self.bytes[index] = total_bytes
+        self.segments[index] = total_segments
+        self.count += 1
+
+    def maybe_sample(self, total_bytes, total_segments=0):
+        """Store a sample if the current interval has ended."""
+        now_ns = time.perf_counter_ns()
+        if now_ns < self.next_sample_ns:
+            return
+        self.next_sample_ns = now_ns + self.interval_ns
+        self._store(now_ns, total_bytes, total_segments)
+        if self.live:
+            previous = (self.count - 2) % self.capacity
+            seconds = (now_ns - self.times[previous]) / 1e9
+            print(f"[{self.name or current_thread().name}] {(now_ns - self.start_ns) / 1e9:6.2f}s"
+                  f" {(total_bytes - self.bytes[previous]) * 8 / seconds:.2f} bits/second")
+
+    def finish(self, total_bytes, total_segments=0):
+        """Store the final sample, so the last partial interval is included."""
+        self._store(time.perf_counter_ns(), total_bytes, total_segments)
+
+    def series(self):
+        """
+        Returns:
+            list: (seconds since start, bits/second, segments/second) for each interval
+            still held in the ring buffer, oldest first.
+        """
+        held = min(self.count, self.capacity)
+        first = self.count - held
+        result = []
+        for i in range(first + 1, self.count):
+            now, before = i % self.capacity, (i - 1) % self.capacity
+            seconds = (self.times[now] - self.times[before]) / 1e9
+            if seconds <= 0:
+                continue
+            result.append(((self.times[now] - self.start_ns) / 1e9,
+                           (self.bytes[now] - self.bytes[before]) * 8 / seconds,
+                           (self.segments[now] - self.segments[before]) / seconds))
+        return result
+
+    def stats(self):
+        """
+        Returns:
+            dict: Peak interval throughput, throughput jitter (standard deviation of
+            the interval throughputs) and the interval series itself.
+        """
+        series = self.series()
+        speeds = [bps for _, bps, _ in series]
+        if not speeds:
+            return {"peak_throughput_bps": 0, "throughput_jitter_bps": 0, "intervals": []}
+        mean = sum(speeds) / len(speeds)
+        jitter = (sum((s - mean) ** 2 for s in speeds) / len(speeds)) ** 0.5
+        return {"peak_throughput_bps": max(speeds), "throughput_jitter_bps": jitter,
+                "intervals": [[round(t, 6), bps, sps] for t, bps, sps in series]}
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records, and counts them, when the queue is full instead of waiting for room."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.drop_lock = threading.Lock()
+
+    def handle(self, record):
+        # Skip the handler lock: the queue is thread-safe, so logging threads don't wait for each other
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def emit(self, record):
+        if self.queue.full():
+            self.count_drop()  # Don't spend any more time on a record that has no room
+            return
+        super().emit(record)
+
+    def prepare(self, record):
+        # The writer thread is in this process and formats the record itself, so there is no
+        # need to format and copy it here as the base class does for other processes
+        return record
 
-    log_file = os.path.join(log_dir, f"{thread_name}.log")
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.count_drop()
 
-    # Clear the log file by opening it in write mode
-    with open(log_file, "w"):
-        pass  # Truncate the file contents
+    def count_drop(self):
+        with self.drop_lock:
+            self.dropped += 1
 
-    thread_name = current_thread().name
+class ThreadFileRouter(logging.Handler):
+    """
+    Write the records of each thread logger to that thread's own rotating log file.
+
+    Only the listener thread calls emit(), so it alone opens, writes and rotates
+    the files; setup_thread_logger() just registers where a logger's file goes.
+    """
+
+    def __init__(self, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.paths = {}  # Logger name -> log file
+        self.files = {}  # Logger name -> open RotatingFileHandler
+        self.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    def register(self, name, path):
+        self.paths[name] = path
+
+    def emit(self, record):
+        path = self.paths.get(record.name)
+        if path is None:
+            return
+        file_handler = self.files.get(record.name)
+        if file_handler is None or file_handler.baseFilename != os.path.abspath(path):
+            if file_handler is not None:
+                file_handler.close()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w"):
+                pass  # Start every thread's log afresh, as one FileHandler per thread used to
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=self.max_bytes,
+                                                                backupCount=self.backups)
+            file_handler.setFormatter(self.formatter)
+            self.files[record.name] = file_handler
+        file_handler.emit(record)
+
+    def close(self):
+        for file_handler in self.files.values():
+            file_handler.close()
+        self.files.clear()
+        super().close()
+
+class LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Wait for room in the bounded queue rather than lose the stop signal
+
+class LogPipeline:
+    """
+    The one log writer of a process.
+
+    Thread loggers share a DroppingQueueHandler that puts records on a bounded
+    queue, and a QueueListener thread writes them out through a ThreadFileRouter,
+    so transfer threads never wait for disk I/O; when the writer falls behind,
+    records are dropped and counted rather than slowing the transfers down.
+    """
+
+    def __init__(self, queue_size=LOG_QUEUE_SIZE, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.router = ThreadFileRouter(max_bytes, backups)
+        self.listener = LogListener(self.queue, self.router)
+        self.listener.start()
+        self.closed = False
+        # Runs at exit in the main process and in worker processes, which skip atexit handlers
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "dropped": self.handler.dropped}
+
+    def close(self):
+        """Write out every queued record, stop the writer thread and close the files."""
+        if self.closed or self.pid != os.getpid():
+            return
+        self.closed = True
+        self.listener.stop()
+        self.router.close()
+
+_log_pipeline = None
+_log_pipeline_lock = threading.Lock()
+
+def log_pipeline():
+    """The LogPipeline of this process, started on first use (and anew in a forked worker process)."""
+    global _log_pipeline
+    with _log_pipeline_lock:
+        if _log_pipeline is None or _log_pipeline.pid != os.getpid():
+            _log_pipeline = LogPipeline()
+        return _log_pipeline
+
+def close_logging():
+    """
+    Flush and stop this process's log writer; the next setup_thread_logger() starts a new one.
+
+    Returns:
+        dict: The closed pipeline's stats() (see LogPipeline), or None if there was none.
+    """
+    global _log_pipeline
+    with _log_pipeline_lock:
+        pipeline, _log_pipeline = _log_pipeline, None
+    if pipeline is None or pipeline.pid != os.getpid():
+        return None
+    pipeline.close()
+    return pipeline.stats()
+
+def setup_thread_logger(log_dir="logs", name=None):
+    """
+    Set up a logger that logs to a unique file for one stream (default: the current thread).
+
+    Records go through the process's LogPipeline; the file, log_dir/<name>.log, is
+    written (and rotated) by its writer thread. Streams run on pool workers, so
+    they pass their own name rather than the worker's.
+
+    Returns:
+        logging.Logger: The stream's logger; its name is the stream name.
+    """
+    thread_name = name or current_thread().name
     logger = logging.getLogger(thread_name)
+    pipeline = log_pipeline()
+    pipeline.router.register(thread_name, os.path.join(log_dir, f"{thread_name}.log"))
+    if pipeline.handler in logger.handlers:
+        return logger  # Pool workers set up their logger once and keep it
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)  # Left over from a closed pipeline, or from the parent of a forked worker
     logger.setLevel(logging.DEBUG)
+    logger.addHandler(pipeline.handler)
+    return logger
 
-    # Create a file handler for the thread
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
+def set_log_level(level):
+    """Keep only records at level ("DEBUG", "INFO", ...) or above in every logger; "OFF" keeps none."""
+    logging.disable(logging.CRITICAL if level == "OFF" else logging.getLevelName(level) - 1)
 
+def _name_stream_process():
+    """Give each worker process its own thread name, and with it its own logger and log file."""
+    current_thread().name = f"Stream-Process-{os.getpid()}"
 
-    # Create a formatter and add it to the handler
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
+def wait_until(start_at):
+    """Sleep until just before the wall-clock time start_at, then spin the rest of the way."""
+    remaining = start_at - time.time()
+    if remaining > 0.002:
+        time.sleep(remaining - 0.002)
+    while time.time() < start_at:
+        pass
 
-    # Add the handler to the logger (if not already added)
-    if not logger.handlers:
-        logger.addHandler(file_handler)
+class StreamPool:
+    """
+    A fixed pool of workers that runs the streams of every round.
 
-    return logger
+    Workers are started once and reused, threads by default or processes to push
+    more than one core's worth of traffic. start_signal() gives each round a common
+    start: a barrier for threads, and a wall-clock start time for processes, which
+    spin up to it on their own cores.
+    """
 
+    def __init__(self, workers, processes=False):
+        self.workers = workers
+        self.processes = processes
+        if processes:
+            self.executor = ProcessPoolExecutor(workers, initializer=_name_stream_process)
+            # Start every worker now; one still starting up when the first round is handed out
+            # would miss that round's start time, which is only STREAM_START_DELAY away
+            for future in [self.executor.submit(os.getpid) for _ in range(workers)]:
+                future.result()
+        else:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="Stream-Worker")
 
+    def submit(self, function, *args, **kwargs):
+        return self.executor.submit(function, *args, **kwargs)
 
+    def start_signal(self, streams):
+        """
+        Return a (barrier, start_at) pair for a round of `streams` streams; one of the two is None.
+
+        Raises:
+            ValueError: If the round has more streams than the pool has workers.
+        """
+        if streams > self.workers:
+            raise ValueError(f"{streams} streams need at least as many workers (the pool has {self.workers})")
+        if self.processes:
+            return None, time.time() + STREAM_START_DELAY
+        return threading.Barrier(streams, timeout=STREAM_START_TIMEOUT), None
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def parse_size(text):
+    """Parse a size such as 512, 64K, 100M or 1G into bytes."""
+    text = text.strip().upper()
+    suffixes = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in suffixes:
+        return int(float(text[:-1]) * suffixes[text[-1]])
+    return int(text)
+
+def result_bytes(result, args):
+    """The byte count recv_into returns, as a timed() size function."""
+    return result
+
+class PhaseCounters:
+    """
+    Calls, bytes and time per phase (recv, unpack, log, sample) of one client transfer.
+
+    summary() turns them into the "phases" field of the transfer record.
+    """
+
+    def __init__(self):
+        self.phases = {}  # Phase name -> [calls, bytes, nanoseconds]
+        self.profile = None
+
+    def wrap(self, phase, function, size=None):
+        counts = self.phases.setdefault(phase, [0, 0, 0])
+        clock = time.perf_counter_ns
+
+        def timed_function(*args):
+            start = clock()
+            result = function(*args)
+            counts[2] += clock() - start
+            counts[0] += 1
+            if size is not None:
+                counts[1] += size(result, args)
+            return result
+        return timed_function
+
+    def summary(self):
+        """{phase: {"calls", "bytes", "seconds", "bytes_per_call"}} for the transfer record."""
+        return {phase: {"calls": calls, "bytes": nbytes, "seconds": nanoseconds / 1e9,
+                        "bytes_per_call": nbytes / calls if calls else 0}
+                for phase, (calls, nbytes, nanoseconds) in self.phases.items() if calls}
+
+def timed(counters, phase, function, size=None):
+    """The function a receive loop should call: counted under phase, or as is while instrumentation is off."""
+    return function if counters is None else counters.wrap(phase, function, size)
+
+def merge_phases(summaries):
+    """Add up the phase summaries of several transfers (None entries are skipped)."""
+    merged = {}
+    for phases in summaries:
+        for phase, stats in (phases or {}).items():
+            total = merged.setdefault(phase, {"calls": 0, "bytes": 0, "seconds": 0.0})
+            total["calls"] += stats["calls"]
+            total["bytes"] += stats["bytes"]
+            total["seconds"] += stats["seconds"]
+    for total in merged.values():
+        total["bytes_per_call"] = total["bytes"] / total["calls"] if total["calls"] else 0
+    return merged
+
+def format_phases(phases):
+    return ", ".join(f"{phase} {stats['calls']} calls {stats['bytes_per_call']:.0f} B/call {stats['seconds']:.3f} s"
+                     for phase, stats in sorted(phases.items()))
+
+class Instrumentation:
+    """
+    Per-phase counting and profiling for the transfers of this client process.
+
+    Each transfer asks transfer() for its counters (None while off) and hands them
+    to finish(), which returns the phases for its record. With a profile file set,
+    the process's first transfer also runs under cProfile.
+    """
 
-class FinishMessenger:
     def __init__(self):
+        self.enabled = False
+        self.profile_path = None
+        self.profile_taken = False
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=False, profile_path=None):
+        self.enabled = enabled or bool(profile_path)
+        self.profile_path = profile_path
+
+    def transfer(self):
+        if not self.enabled:
+            return None
+        counters = PhaseCounters()
+        with self.lock:
+            if self.profile_path and not self.profile_taken:
+                self.profile_taken = True
+                counters.profile = cProfile.Profile()
+        if counters.profile:
+            counters.profile.enable()  # Profiles the calling thread only
+        return counters
+
+    def finish(self, counters):
+        if counters is None:
+            return None
+        if counters.profile:
+            counters.profile.disable()
+            counters.profile.dump_stats(self.profile_path)
+            print(f"Profile of one transfer written to {self.profile_path}"
+                  f" (view it with: python -m pstats {self.profile_path})")
+            counters.profile = None
+        return counters.summary()
+
+INSTRUMENTATION = Instrumentation()
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list (0 for an empty list)."""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+class MetricsWriter:
+    """
+    Write transfer records to a JSON Lines or CSV file from a background thread.
+
+    write() only puts the record on a queue, so transfer threads never wait for
+    disk I/O. The format follows the file extension: .csv for CSV, anything else
+    for JSON Lines.
+    """
+
+    FIELDS = ("protocol", "thread", "server", "start_time", "end_time", "duration", "bytes", "segments",
+              "total_segments", "loss_percent", "throughput_bps", "peak_throughput_bps", "throughput_jitter_bps",
+              "duplicates", "reordered", "max_reorder_depth", "delay_mean_ms", "delay_max_ms", "jitter_ms",
+              "nack_rounds", "retransmit_requested", "requests", "request_size", "rtt_p50_ms", "rtt_p95_ms",
+              "rtt_p99_ms", "rcvbuf", "socket_drops", "buffer_loss_percent")
+    # The nested per-phase counters ("phases") only go to JSON Lines
+
+    def __init__(self, path):
+        self.path = path
+        self.records = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._write_records, name="Metrics-Writer", daemon=True)
+        self.writer_thread.start()
+
+    def write(self, record):
+        self.records.put(record)
+
+    def close(self):
+        """Write out everything queued so far and stop the writer thread."""
+        self.records.put(None)
+        self.writer_thread.join()
+
+    def _write_records(self):
+        is_csv = self.path.lower().endswith(".csv")
+        write_header = is_csv and (not os.path.exists(self.path) or os.path.getsize(self.path) == 0)
+        with open(self.path, "a", newline="") as out:
+            csv_writer = csv.DictWriter(out, fieldnames=self.FIELDS, extrasaction="ignore") if is_csv else None
+            if write_header:
+                csv_writer.writeheader()
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                if csv_writer:
+                    csv_writer.writerow(record)
+                else:
+                    out.write(json.dumps(record) + "\n")
+                if self.records.empty():
+                    out.flush()  # Flush once the queue is drained rather than per record
+
+class FinishMessenger:
+    """
+    Report finished transfers: one line on stdout each, plus a structured record.
+
+    Records are kept for round_summary() and, when a MetricsWriter is given,
+    streamed to it.
+    """
+
+    def __init__(self, metrics_writer=None):
         self.udp_counter = 0
         self.tcp_counter = 0
         self.udp_lock = threading.Lock()
         self.tcp_lock = threading.Lock()
+        self.metrics_writer = metrics_writer
+        self.records = []
+        self.round_trips = []
+
+    def _record(self, protocol, total_time, total_speed, sampler=None, packet_stats=None, reliability=None,
+                socket_stats=None, phases=None, **fields):
+        """
+        Build and keep the structured record of one transfer.
 
-    def udp_finished(self, total_time, total_speed, success_rate):
+        fields are record columns (thread, start_time, end_time, bytes, segments, server, ...);
+        the stats dicts and the sampler's stats are merged in.
+        """
+        record = {
+            "protocol": protocol,
+            "thread": current_thread().name,
+            "server": None,
+            "start_time": None,
+            "end_time": None,
+            "duration": total_time,
+            "bytes": None,
+            "segments": None,
+            "total_segments": None,
+            "loss_percent": None,
+            "throughput_bps": total_speed,
+        }
+        record.update(fields)
+        if sampler is not None:
+            record.update(sampler.stats())
+        if packet_stats:
+            record.update(packet_stats)
+        if reliability:
+            record.update(reliability)
+        if socket_stats:
+            record.update(socket_stats)
+        if phases:
+            record["phases"] = phases
+        self.records.append(record)
+        if self.metrics_writer:
+            self.metrics_writer.write(record)
+
+    def udp_finished(self, total_time, total_speed, success_rate, **extra):
+        """Print a finished UDP transfer; extra goes to its record (see _record)."""
+        packet_stats = extra.get("packet_stats")
+        reliability = extra.get("reliability")
+        socket_stats = extra.get("socket_stats")
         with self.udp_lock:
             self.udp_counter += 1
+            if extra.get("rejected"):
+                print(f"UDP transfer #{self.udp_counter} rejected by the server"
+                      f" (too many transfers or over its size limit)")
             print(f"UDP transfer #{self.udp_counter} finished, total time: {total_time:.2f} seconds,"
                   f" total speed {total_speed:.2f} bits/second, percentage of packets received successfully:"
                   f" {success_rate:.2f}%")
+            if packet_stats:
+                print(f"UDP transfer #{self.udp_counter} jitter: {packet_stats['jitter_ms']:.3f} ms, relative delay"
+                      f" mean/max {packet_stats['delay_mean_ms']:.3f}/{packet_stats['delay_max_ms']:.3f} ms,"
+                      f" reordered: {packet_stats['reordered']} (max depth {packet_stats['max_reorder_depth']}),"
+                      f" duplicates: {packet_stats['duplicates']}")
+            if reliability:
+                print(f"UDP transfer #{self.udp_counter} NACK rounds: {reliability['nack_rounds']},"
+                      f" segments requested again: {reliability['retransmit_requested']}")
+            if socket_stats and socket_stats.get("socket_drops"):
+                print(f"UDP transfer #{self.udp_counter} socket buffer drops: {socket_stats['socket_drops']}"
+                      f" ({socket_stats['buffer_loss_percent']:.2f}% of the datagrams that reached this host"
+                      f" found the {socket_stats['rcvbuf']}-byte receive buffer full)")
+            self._record("UDP", total_time, total_speed, loss_percent=100 - success_rate, **extra)
 
-    def tcp_finished(self, total_time, total_speed):
+    def tcp_finished(self, total_time, total_speed, **extra):
+        """Print a finished TCP transfer; extra goes to its record (see _record)."""
         with self.tcp_lock:
             self.tcp_counter += 1
             print(f"TCP transfer #{self.tcp_counter} finished, total time: {total_time:.2f} seconds,"
                   f" total speed {total_speed:.2f} bits/second")
+            self._record("TCP", total_time, total_speed, **extra)
+
+    def merge(self, records, round_trips=()):
+        """Add the transfers a stream reported in a worker process to this round."""
+        with self.udp_lock, self.tcp_lock:
+            self.udp_counter += sum(record["protocol"] == "UDP" for record in records)
+            self.tcp_counter += sum(record["protocol"] == "TCP" for record in records)
+            self.records.extend(records)
+            self.round_trips.extend(round_trips)
+            if self.metrics_writer:
+                for record in records:
+                    self.metrics_writer.write(record)
+
+    def tcp_latency(self, round_trips, request_size, server=None, phases=None, thread=None):
+        """Report the round-trip times (seconds) of small TCP session requests, kept apart from throughput."""
+        ordered = sorted(round_trips)
+        with self.tcp_lock:
+            self.round_trips.extend(round_trips)
+            print(f"TCP session: {len(ordered)} requests of {request_size} bytes, round trip p50/p95/p99"
+                  f" {percentile(ordered, 0.50) * 1e3:.3f}/{percentile(ordered, 0.95) * 1e3:.3f}"
+                  f"/{percentile(ordered, 0.99) * 1e3:.3f} ms")
+            record = {
+                "protocol": "TCP-RTT",
+                "thread": thread or current_thread().name,
+                "server": server,
+                "duration": sum(ordered),
+                "bytes": len(ordered) * request_size,
+                "requests": len(ordered),
+                "request_size": request_size,
+                "rtt_p50_ms": percentile(ordered, 0.50) * 1e3,
+                "rtt_p95_ms": percentile(ordered, 0.95) * 1e3,
+                "rtt_p99_ms": percentile(ordered, 0.99) * 1e3,
+            }
+            if phases:
+                record["phases"] = phases
+            self.records.append(record)
+            if self.metrics_writer:
+                self.metrics_writer.write(record)
+
+    def round_summary(self):
+        """
+        Aggregate the recorded transfers per protocol.
+
+        Returns:
+            dict: Per protocol, the transfer count, summed throughput, throughput over
+            the common window (all bytes / first start to last end) and the p50/p95/p99
+            of per-transfer throughput (bits/second); small TCP session
+            requests are summarized separately under "TCP-RTT" (milliseconds).
+        """
+        summary = {}
+        for protocol in ("UDP", "TCP"):
+            records = [r for r in self.records if r["protocol"] == protocol]
+            speeds = sorted(r["throughput_bps"] for r in records)
+            if not speeds:
+                continue
+            timed = [r for r in records if r["start_time"] is not None and r["bytes"] is not None]
+            window = max(r["end_time"] for r in timed) - min(r["start_time"] for r in timed) if timed else 0
+            summary[protocol] = {
+                "transfers": len(speeds),
+                "sum_throughput_bps": sum(speeds),
+                "window_throughput_bps": sum(r["bytes"] for r in timed) * 8 / window if window > 0 else 0,
+                "p50_throughput_bps": percentile(speeds, 0.50),
+                "p95_throughput_bps": percentile(speeds, 0.95),
+                "p99_throughput_bps": percentile(speeds, 0.99),
+            }
+        if self.round_trips:
+            round_trips = sorted(self.round_trips)
+            summary["TCP-RTT"] = {
+                "requests": len(round_trips),
+                "p50_rtt_ms": percentile(round_trips, 0.50) * 1e3,
+                "p95_rtt_ms": percentile(round_trips, 0.95) * 1e3,
+                "p99_rtt_ms": percentile(round_trips, 0.99) * 1e3,
+            }
+        return summary
+
+    def server_summary(self):
+        """
+        Total throughput per server and protocol, to compare servers tested in the same round.
+
+        Returns:
+            dict: {server ip: {"UDP"/"TCP": summed throughput (bits/second)}}.
+        """
+        summary = {}
+        for record in self.records:
+            if record["protocol"] in ("UDP", "TCP") and record.get("server"):
+                totals = summary.setdefault(record["server"], {})
+                totals[record["protocol"]] = totals.get(record["protocol"], 0) + record["throughput_bps"]
+        return summary
+
+    def print_summary(self):
+        servers = self.server_summary()
+        if len(servers) > 1:
+            for server, totals in servers.items():
+                print(f"Server {server}: " + ", ".join(f"{protocol} {speed:.2f} bits/second"
+                                                       for protocol, speed in sorted(totals.items())))
+        for protocol, stats in self.round_summary().items():
+            if protocol == "TCP-RTT":
+                print(f"TCP round trip summary: {stats['requests']} requests, p50/p95/p99"
+                      f" {stats['p50_rtt_ms']:.3f}/{stats['p95_rtt_ms']:.3f}/{stats['p99_rtt_ms']:.3f} ms")
+                continue
+            print(f"{protocol} round summary: {stats['transfers']} transfers, total speed"
+                  f" {stats['sum_throughput_bps']:.2f} bits/second ({stats['window_throughput_bps']:.2f} over the"
+                  f" common window), p50/p95/p99 per transfer"
+                  f" {stats['p50_throughput_bps']:.2f}/{stats['p95_throughput_bps']:.2f}"
+                  f"/{stats['p99_throughput_bps']:.2f} bits/second")
+        phases = merge_phases(record.get("phases") for record in self.records)
+        if phases:
+            print("Phase summary: " + format_phases(phases))
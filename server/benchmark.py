@@ -0,0 +1,238 @@
+"""
+Micro-benchmarks for the server send paths.
+
+Run from the server directory, e.g.:
+    python benchmark.py tcp --sizes 1M 100M 1G 10G
+    python benchmark.py udp --segments 200000 --segment-sizes 512 1400 8192 65000
+    python benchmark.py load --connections 1000 --concurrency 100
+"""
+import argparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SEGMENT_SIZE, GSO_MAX_SEGMENTS, TCP_REQUEST_PORT, UDP_REQUEST_PORT
+from utils import gso_batch_size, pack_payload_message, payload_header_size, send_tcp_payload, send_udp_payloads
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse a size such as 512, 64K, 100M or 10G into bytes."""
+    text = text.strip().upper()
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KB, or None if unknown."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def drain(sock, buffer_size=1 << 20):
+    """Read from sock into one reused buffer until the peer closes; return the byte count."""
+    buffer = bytearray(buffer_size)
+    received = 0
+    while True:
+        n = sock.recv_into(buffer)
+        if not n:
+            return received
+        received += n
+
+
+def legacy_tcp_send(sock, total_size):
+    """The original send path: build the whole payload in memory, then sendall."""
+    sock.sendall(b'X' * total_size)
+    return total_size
+
+
+def run_tcp_transfer(send_function, total_size):
+    """Send total_size bytes over a loopback connection; return (seconds, bytes received)."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+
+    result = {}
+    drain_thread = threading.Thread(target=lambda: result.update(received=drain(receiver)))
+    drain_thread.start()
+    start = time.perf_counter()
+    try:
+        send_function(sender, total_size)
+    finally:
+        sender.close()
+    drain_thread.join()
+    elapsed = time.perf_counter() - start
+    receiver.close()
+    return elapsed, result.get("received", 0)
+
+
+def bench_tcp(args):
+    send_function = legacy_tcp_send if args.legacy else send_tcp_payload
+    print(f"{'size':>12} {'seconds':>9} {'Mbps':>10} {'peak RSS KB':>12}")
+    for size_text in args.sizes:
+        size = parse_size(size_text)
+        elapsed, received = run_tcp_transfer(send_function, size)
+        if received != size:
+            print(f"{size_text:>12} short transfer: {received}/{size} bytes")
+            continue
+        mbps = size * 8 / elapsed / 1e6
+        print(f"{size_text:>12} {elapsed:9.3f} {mbps:10.1f} {peak_rss_kb() or '-':>12}")
+
+
+def legacy_udp_send(sock, client_address, segment_count, payload_size):
+    """The original send path: pack a fresh datagram for every segment."""
+    for segment_number in range(segment_count):
+        sock.sendto(pack_payload_message(segment_count, segment_number, payload_size), client_address)
+    return segment_count
+
+
+def bench_udp(args):
+    # The sink is never read; loopback drops what overflows its buffer, which is all we need
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    print(f"{'path':>10} {'segment':>8} {'segments':>10} {'seconds':>9} {'packets/s':>12} {'Mbps':>10}")
+    try:
+        for segment_size in args.segment_sizes:
+            gso_segments = gso_batch_size(payload_header_size() + segment_size, GSO_MAX_SEGMENTS)
+            paths = [("legacy", legacy_udp_send), ("template", send_udp_payloads)]
+            if gso_segments > 1:
+                paths.append(("gso", lambda sock, address, count, size:
+                              send_udp_payloads(sock, address, count, size, gso_segments=gso_segments)))
+            for name, send_function in paths:
+                start = time.perf_counter()
+                send_function(sender, sink.getsockname(), args.segments, segment_size)
+                elapsed = time.perf_counter() - start
+                mbps = args.segments * segment_size * 8 / elapsed / 1e6
+                print(f"{name:>10} {segment_size:>8} {args.segments:>10} {elapsed:9.3f}"
+                      f" {args.segments / elapsed:12.0f} {mbps:10.1f}")
+    finally:
+        sender.close()
+        sink.close()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def start_server_process(mode, extra_args=()):
+    """Start server.py in a subprocess and wait until its TCP port accepts connections."""
+    server_dir = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, "server.py", "--mode", mode, *extra_args], cwd=server_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", TCP_REQUEST_PORT), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server ({mode}) did not start listening on port {TCP_REQUEST_PORT}")
+
+
+def tcp_request_latency(size):
+    """Open a connection, request size bytes and read them all; return the latency in seconds."""
+    start = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", TCP_REQUEST_PORT)) as sock:
+        sock.sendall(f"{size}\n".encode())
+        drain(sock, 65536)
+    return time.perf_counter() - start
+
+
+def udp_request_latency(size, timeout=1.0):
+    """Send a UDP request and wait for its last segment; return the latency, or None on loss."""
+    segment_count = (size + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+    buffer = bytearray(65536)
+    start = time.perf_counter()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(struct.pack(">LBQ", 0xabcddcba, 0x3, size), ("127.0.0.1", UDP_REQUEST_PORT))
+        received = 0
+        try:
+            while received < segment_count:
+                sock.recv_into(buffer)
+                received += 1
+        except socket.timeout:
+            return None
+    return time.perf_counter() - start
+
+
+def run_load(request_function, size, connections, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(lambda _: request_function(size), range(connections)))
+    elapsed = time.perf_counter() - start
+    completed = sorted(latency for latency in latencies if latency is not None)
+    return elapsed, completed
+
+
+def bench_load(args):
+    modes = ("threaded", "async") if args.mode == "both" else (args.mode,)
+    print(f"{'mode':>9} {'proto':>5} {'done':>7} {'req/s':>9} {'Mbps':>9}"
+          f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode in modes:
+        process = start_server_process(mode, ("--workers", str(args.workers)))
+        try:
+            for proto, request_function, size in (("TCP", tcp_request_latency, args.size),
+                                                  ("UDP", udp_request_latency, args.udp_size)):
+                elapsed, completed = run_load(request_function, size, args.connections, args.concurrency)
+                mbps = len(completed) * size * 8 / elapsed / 1e6
+                print(f"{mode:>9} {proto:>5} {len(completed):>7} {len(completed) / elapsed:9.0f} {mbps:9.1f}"
+                      f" {percentile(completed, 0.50) * 1e3:8.2f} {percentile(completed, 0.95) * 1e3:8.2f}"
+                      f" {percentile(completed, 0.99) * 1e3:8.2f} {(completed[-1] if completed else 0) * 1e3:8.2f}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server send-path benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tcp_parser = subparsers.add_parser("tcp", help="TCP payload streaming: throughput and peak RSS per request size")
+    tcp_parser.add_argument("--sizes", nargs="+", default=["1M", "10M", "100M", "1G", "10G"])
+    tcp_parser.add_argument("--legacy", action="store_true", help="use the old b'X' * size sendall path")
+    tcp_parser.set_defaults(func=bench_tcp)
+
+    udp_parser = subparsers.add_parser("udp",
+                                       help="UDP segment sending: packets/sec and Mbps per path and segment size")
+    udp_parser.add_argument("--segments", type=int, default=200000)
+    udp_parser.add_argument("--segment-sizes", type=int, nargs="+", default=[SEGMENT_SIZE, 1400, 8192, 65000])
+    udp_parser.set_defaults(func=bench_udp)
+
+    load_parser = subparsers.add_parser("load", help="Requests/sec and tail latency against a server subprocess")
+    load_parser.add_argument("--mode", choices=("threaded", "async", "both"), default="both")
+    load_parser.add_argument("--connections", type=int, default=1000, help="requests per protocol")
+    load_parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at once")
+    load_parser.add_argument("--size", type=int, default=65536, help="bytes per TCP request")
+    load_parser.add_argument("--udp-size", type=int, default=16384, help="bytes per UDP request")
+    load_parser.add_argument("--workers", type=int, default=1, help="server processes (SO_REUSEPORT sharding)")
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
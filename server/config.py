@@ -9,21 +9,55 @@ UDP_REQUEST_PORT = 6000           # Port for UDP requests
 MAGIC_COOKIE = 0xabcddcba         # Magic cookie value
 OFFER_MESSAGE_TYPE = 0x2          # Offer message type
 BROADCAST_INTERVAL = 1            # Interval between broadcast messages (in seconds)
-SEGMENT_SIZE = 512                # Size of each payload segment
+SEGMENT_SIZE = 512                # Size of each payload segment, unless the client asks for another
+MAX_SEGMENT_SIZE = 65470          # Largest segment a client may request (UDP limit minus header)
+UDP_GSO = True                    # Send UDP segments in Linux GSO batches when available
+GSO_MAX_SEGMENTS = 64             # Segments per GSO batch (the kernel limit is 64)
+TCP_CHUNK_SIZE = 65536            # Reusable buffer for streaming TCP payloads
+TCP_SESSION_TIMEOUT = 300         # Seconds a TCP session may idle between requests
+TCP_REQUEST_TIMEOUT = 5           # Seconds a new TCP connection has to send its request
+ASYNC_UDP_BATCH = 64              # Segments sent before yielding to the event loop
+UDP_DEFAULT_RATE = 0              # UDP pacing in bits/second if the client asks for none (0 = off)
+UDP_MAX_RATE = 0                  # Cap on requested UDP rates in bits/second (0 = none)
+UDP_PACING_BURST = 32             # Segments a paced transfer may send back to back
+INSTRUMENT = False                # Count calls, bytes and time per transfer phase
+PROFILE_FILE = None               # cProfile the first transfer into this file (None = off)
+STATS_INTERVAL = 0                # Seconds between stats reports (0 = off)
 
 # General Configuration
 MAX_CONNECTIONS = 10              # Maximum number of simultaneous connections
 
+# Admission Control
+MAX_TRANSFER_SIZE = 1 << 34       # Largest transfer in bytes a client may request
+MAX_ACTIVE_TRANSFERS = 64         # UDP transfers sent at once, round robin
+MAX_QUEUED_TRANSFERS = 256        # UDP transfers that may wait for a place
+MAX_TCP_CONNECTIONS = 256         # TCP connections served at once; more are closed
+SCHEDULER_QUANTUM = 64            # Segments per UDP transfer turn (at most a paced burst)
+CLIENT_MAX_RATE = 0               # Cap per client address in bits/second (0 = none)
+SERVER_MAX_RATE = 0               # Cap over all transfers in bits/second (0 = none)
+RATE_LIMIT_BURST = 262144         # Bytes that may be sent back to back under those caps
+
+# Socket Buffers
+# Send buffers are sized rate x RTT, capped by wmem_max, unless SOCKET_BUFFER_SIZE is set
+SOCKET_BUFFER_RTT = 0.05          # Round-trip time in seconds
+SOCKET_BUFFER_RATE = 1000000000   # Rate in bits/second when no rate cap is configured
+SOCKET_BUFFER_SIZE = 0            # Fixed size in bytes (0 = auto)
+
 
 
 
 def get_own_ip():
     hostname = socket.gethostname()
-    ip_address = socket.gethostbyname(hostname)
+    try:
+        ip_address = socket.gethostbyname(hostname)
+    except OSError:
+        ip_address = "127.0.0.1"  # Hostname does not resolve; fall back to loopback
     return ip_address
-def set_broadcast_ip():
+def set_broadcast_ip(b_ip=None):
+    """Set BROADCAST_IP to b_ip, or to the x.y.z.255 address of this host's network."""
     global BROADCAST_IP
-    b_ip = get_own_ip()[:-3]+"255"
+    if b_ip is None:
+        b_ip = get_own_ip().rsplit(".", 1)[0] + ".255"
     BROADCAST_IP = b_ip
     return b_ip
 BROADCAST_IP = set_broadcast_ip()
@@ -1,10 +1,27 @@
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import signal
 import socket
+import sys
 import time
-from config import BROADCAST_IP, BROADCAST_PORT, UDP_REQUEST_PORT, TCP_REQUEST_PORT, BROADCAST_INTERVAL, \
-    MAX_CONNECTIONS, SEGMENT_SIZE, get_own_ip, set_broadcast_ip
-from utils import create_udp_broadcast_socket, pack_offer_message, pack_payload_message
+from config import BROADCAST_PORT, UDP_REQUEST_PORT, TCP_REQUEST_PORT, BROADCAST_INTERVAL, \
+    MAX_CONNECTIONS, SEGMENT_SIZE, MAX_SEGMENT_SIZE, UDP_GSO, GSO_MAX_SEGMENTS, ASYNC_UDP_BATCH, UDP_DEFAULT_RATE, \
+    UDP_MAX_RATE, UDP_PACING_BURST, TCP_SESSION_TIMEOUT, TCP_REQUEST_TIMEOUT, INSTRUMENT, PROFILE_FILE, \
+    STATS_INTERVAL, MAX_TRANSFER_SIZE, MAX_ACTIVE_TRANSFERS, MAX_QUEUED_TRANSFERS, MAX_TCP_CONNECTIONS, \
+    SCHEDULER_QUANTUM, CLIENT_MAX_RATE, SERVER_MAX_RATE, RATE_LIMIT_BURST, SOCKET_BUFFER_RTT, SOCKET_BUFFER_RATE, \
+    SOCKET_BUFFER_SIZE, get_own_ip, set_broadcast_ip
+from utils import create_udp_broadcast_socket, pack_offer_message, send_tcp_payload, UdpPayloadSender, \
+    unpack_udp_request, unpack_nack, iter_nack_segments, iter_tcp_payload_chunks, build_payload_template, \
+    make_segment_writer, create_pacer, payload_header_size, gso_batch_size, unpack_tcp_request, recv_exact, \
+    timed, argument_bytes, TokenBucket, INSTRUMENTATION, REQUEST_FLAG_TIMESTAMPS, TCP_REQUEST, \
+    REJECTION_MESSAGE, set_send_buffer
 import threading
-import struct
+from collections import deque, namedtuple
+from itertools import islice
+
+import config
 
 from colorama import init, Fore, Style
 """
@@ -15,17 +32,155 @@ WHITE - finished sending
 GREEN - server started / listening / thread start / sent
 BLUE - recieved
 GREEN - thread start
+MAGENTA - stats
 """
-def broadcast_offers():
+ServerAddresses = namedtuple("ServerAddresses", ["host", "tcp_port", "udp_port", "broadcast_ip", "broadcast_port"])
+
+def default_addresses():
+    """The addresses from config, read when called so that set_broadcast_ip() is taken into account."""
+    return ServerAddresses("", TCP_REQUEST_PORT, UDP_REQUEST_PORT, config.BROADCAST_IP, BROADCAST_PORT)
+
+TransferLimits = namedtuple("TransferLimits", ["max_size", "max_active", "max_queued", "max_tcp_connections",
+                                               "client_rate", "server_rate"])
+TransferControls = namedtuple("TransferControls", ["tcp", "udp", "bandwidth"])
+
+def default_limits():
+    return TransferLimits(MAX_TRANSFER_SIZE, MAX_ACTIVE_TRANSFERS, MAX_QUEUED_TRANSFERS, MAX_TCP_CONNECTIONS,
+                          CLIENT_MAX_RATE, SERVER_MAX_RATE)
+
+class TransferAdmission:
+    """
+    Admit transfers up to a bound: max_active at once, max_queued more waiting, the rest are rejected.
+
+    Requests over max_size bytes are rejected as well. Callers move an admitted
+    transfer along with start() and finish(); the counts feed the stats report.
+    """
+
+    def __init__(self, max_size, max_active, max_queued=0):
+        self.max_size = max_size
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.admitted = 0
+        self.rejected_busy = 0
+        self.rejected_size = 0
+        self.lock = threading.Lock()
+
+    def check_size(self, size):
+        """Return why a request for size bytes is rejected, or None if it is within max_size."""
+        if size <= self.max_size:
+            return None
+        with self.lock:
+            self.rejected_size += 1
+        return f"{size} bytes is over the {self.max_size}-byte limit"
+
+    def admit(self, size=0):
+        """
+        Queue a transfer of size bytes if there is room.
+
+        Returns:
+            str: Why the transfer was rejected, or None if it was admitted.
+        """
+        reason = self.check_size(size)
+        if reason:
+            return reason
+        with self.lock:
+            if self.active + self.queued >= self.max_active + self.max_queued:
+                self.rejected_busy += 1
+                return f"{self.active} transfers active and {self.queued} queued"
+            self.admitted += 1
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        return None
+
+    def start(self):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+
+    def finish(self):
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"active": self.active, "queued": self.queued, "peak_queued": self.peak_queued,
+                    "admitted": self.admitted, "rejected_busy": self.rejected_busy,
+                    "rejected_size": self.rejected_size}
+
+class CappedPacer:
+    """Pace one transfer by several token buckets at once: its own rate and the client and server caps."""
+
+    def __init__(self, buckets, lock):
+        self.buckets = buckets
+        self.lock = lock
+        self.burst = min(bucket.burst for bucket in buckets)
+
+    def reserve(self, amount):
+        with self.lock:
+            return max(bucket.reserve(amount) for bucket in self.buckets)
+
+class BandwidthLimits:
+    """
+    The per-client and server-wide bandwidth caps, as token buckets shared by all transfers.
+
+    open() gives a transfer the pacer to send with (None if nothing limits it) and
+    close() releases the client's bucket once its last transfer is done.
+    """
+
+    def __init__(self, client_rate=CLIENT_MAX_RATE, server_rate=SERVER_MAX_RATE, burst_bytes=RATE_LIMIT_BURST):
+        self.client_rate = client_rate
+        self.server_rate = server_rate
+        self.burst_bytes = burst_bytes
+        self.server_bucket = TokenBucket(server_rate, burst_bytes) if server_rate else None
+        self.client_buckets = {}  # Client address -> [bucket, transfers using it]
+        self.lock = threading.Lock()
+
+    def open(self, client, pacer=None):
+        shared = []
+        with self.lock:
+            if self.server_bucket is not None:
+                shared.append(self.server_bucket)
+            if self.client_rate:
+                entry = self.client_buckets.get(client)
+                if entry is None:
+                    entry = self.client_buckets[client] = [TokenBucket(self.client_rate, self.burst_bytes), 0]
+                entry[1] += 1
+                shared.append(entry[0])
+        if not shared:
+            return pacer
+        return CappedPacer(([pacer] if pacer is not None else []) + shared, self.lock)
+
+    def close(self, client):
+        with self.lock:
+            entry = self.client_buckets.get(client)
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.client_buckets[client]
+
+def make_controls(limits):
+    return TransferControls(TransferAdmission(limits.max_size, limits.max_tcp_connections),
+                            TransferAdmission(limits.max_size, limits.max_active, limits.max_queued),
+                            BandwidthLimits(limits.client_rate, limits.server_rate))
+
+def tune_send_buffer(sock, controls, tcp=False):
+    """Size sock's send buffer (SOCKET_BUFFER_SIZE, or the server-wide rate cap x RTT); returns the effective size."""
+    rate = controls.bandwidth.server_rate or UDP_MAX_RATE or SOCKET_BUFFER_RATE
+    return set_send_buffer(sock, SOCKET_BUFFER_SIZE or int(rate * SOCKET_BUFFER_RTT / 8), tcp)
+
+def broadcast_offers(addresses):
     """Broadcast offer messages via UDP on a separate thread."""
     # Create a UDP socket for broadcasting
     sock = create_udp_broadcast_socket()
-    offer_message = pack_offer_message(UDP_REQUEST_PORT, TCP_REQUEST_PORT)
+    offer_message = pack_offer_message(addresses.udp_port, addresses.tcp_port)
 
     try:
         while True:
             # Send the offer message as a broadcast
-            sock.sendto(offer_message, (BROADCAST_IP, BROADCAST_PORT))
+            sock.sendto(offer_message, (addresses.broadcast_ip, addresses.broadcast_port))
             # print(f"Broadcasting offer: UDP={UDP_REQUEST_PORT}, TCP={TCP_REQUEST_PORT}")
             time.sleep(BROADCAST_INTERVAL)
     except KeyboardInterrupt:
@@ -33,107 +188,519 @@ def broadcast_offers():
     finally:
         sock.close()
 
-def handle_tcp_connection(client_socket, address):
-    """Handle a single TCP connection."""
+def handle_tcp_connection(client_socket, address, controls):
+    """Handle a single, admitted TCP connection: one text request, or a session of binary ones."""
     # print(f"New TCP connection from {address}")
     print(Fore.YELLOW + f"New TCP connection from {address}" )
+    controls.tcp.start()
+    counters = INSTRUMENTATION.transfer(address[0])
+    pacer = controls.bandwidth.open(address[0])
     try:
+        # An admitted connection holds a MAX_TCP_CONNECTIONS place, so it gets little time to send its request
+        client_socket.settimeout(TCP_REQUEST_TIMEOUT)
+        first = client_socket.recv(1, socket.MSG_PEEK)
+        if first and not first.isdigit():
+            handle_tcp_session(client_socket, address, controls, counters, pacer)
+            return
+
         # Read the requested file size
-        data = client_socket.recv(1024).decode().strip()
-        file_size = int(data)  # Expecting a numeric string followed by '\n'
+        data = client_socket.recv(1024)
+        try:
+            file_size = int(data.decode().strip())  # Expecting a numeric string followed by '\n'
+        except ValueError:
+            print(Fore.RED+f"Invalid TCP request {data[:32]!r} from {address}. Closed.")
+            return
         print(Fore.CYAN+f"Client requested file size: {file_size} bytes")
+        reason = controls.tcp.check_size(file_size)
+        if reason:
+            print(Fore.RED+f"Rejected TCP request from {address}: {reason}")
+            return
 
-        # Send the requested data back as a string of 'X's
-        client_socket.sendall(b'X' * file_size)
+        # Stream the requested data back as 'X's from a reusable buffer; sendall's timeout would cap the whole transfer
+        client_socket.settimeout(None)
+        send_tcp_payload(client_socket, file_size, counters=counters, pacer=pacer)
         print(Fore.GREEN+f"Sent {file_size} bytes to {address}")
+    except socket.timeout:
+        print(Fore.RED+f"Closed idle TCP connection from {address}")
     except Exception as e:
         print(Fore.RED+f"Error handling TCP connection from {address}: {e}")
     finally:
+        controls.bandwidth.close(address[0])
+        controls.tcp.finish()
+        INSTRUMENTATION.finish(counters)
         client_socket.close()
 
-def start_tcp_server():
+def handle_tcp_session(client_socket, address, controls, counters=None, pacer=None):
+    """Answer TCP session requests on one connection until the client closes it or asks for too much."""
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't hold back small responses
+    client_socket.settimeout(TCP_SESSION_TIMEOUT)
+    requests = 0
+    while True:
+        data = recv_exact(client_socket, TCP_REQUEST.size)
+        if not data:
+            break
+        file_size = unpack_tcp_request(data)
+        reason = controls.tcp.check_size(file_size)
+        if reason:
+            print(Fore.RED+f"Rejected TCP session request from {address}: {reason}")
+            break
+        send_tcp_payload(client_socket, file_size, counters=counters, pacer=pacer)
+        requests += 1
+    print(Fore.GREEN+f"TCP session with {address} closed after {requests} requests")
+
+def start_tcp_server(addresses, controls, reuse_port=False):
     """Start a TCP server for handling client requests."""
     import socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(("", TCP_REQUEST_PORT))
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Rebind despite TIME_WAIT sockets
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Share the port with other workers
+    sndbuf = tune_send_buffer(server_socket, controls, tcp=True)  # Accepted connections inherit it
+    server_socket.bind((addresses.host, addresses.tcp_port))
     server_socket.listen(MAX_CONNECTIONS)
-    print(Fore.GREEN+f"Server started, listening on IP address {get_own_ip()}")
+    print(Fore.GREEN+f"Server started, listening on IP address {get_own_ip()} (TCP send buffer {sndbuf} bytes)")
 
     try:
         while True:
             client_socket, address = server_socket.accept()
-            threading.Thread(target=handle_tcp_connection, args=(client_socket, address)).start()
+            reason = controls.tcp.admit()
+            if reason:
+                print(Fore.RED+f"Rejected TCP connection from {address}: {reason}")
+                client_socket.close()
+                continue
+            threading.Thread(target=handle_tcp_connection, args=(client_socket, address, controls)).start()
     except KeyboardInterrupt:
         print(Fore.RED+"Stopping TCP server...")
     finally:
         server_socket.close()
 
-def handle_udp_client(data, client_address, server_socket):
+UdpTransfer = namedtuple("UdpTransfer", ["segment_count", "segment_size", "rate", "timestamped", "segments", "size",
+                                         "first_sequence"])
+
+def request_segment_size(requested_size):
+    """The segment size to use: the client's choice within MAX_SEGMENT_SIZE, or SEGMENT_SIZE."""
+    if not requested_size:
+        return SEGMENT_SIZE
+    return min(requested_size, MAX_SEGMENT_SIZE)
+
+def plan_udp_transfer(data, client_address):
     """
-    Handle a single UDP client's request in a separate thread.
+    Turn a UDP request (type 0x3) or NACK (type 0x6) into the transfer to send.
+
+    A request covers every segment; a NACK only the ranges the client is missing, with
+    sequence numbers from segment_count up to mark them as retransmissions.
+    Raises ValueError for anything else.
     """
-    try:
-        # Parse the request packet
-        magic_cookie, message_type, requested_size = struct.unpack(">LBQ", data[:13])
-        if magic_cookie != 0xabcddcba or message_type != 0x3:
-            print(Fore.RED+f"Invalid magic cookie or message type from {client_address}. Ignored.")
-            return
+    if len(data) > 4 and data[4] == 0x6:
+        nack = unpack_nack(data)
+        missing = sum(count for _, count in nack.ranges)
+        print(Fore.CYAN+f"NACK received from {client_address}: {missing} segments in {len(nack.ranges)} ranges")
+        segment_size = request_segment_size(nack.segment_size)
+        return UdpTransfer(nack.total_segments, segment_size, nack.rate, bool(nack.flags & REQUEST_FLAG_TIMESTAMPS),
+                           iter_nack_segments(nack.ranges), missing * segment_size, nack.total_segments)
 
-        print(Fore.CYAN+f"Valid request received from {client_address}: {requested_size} bytes requested")
+    request = unpack_udp_request(data)
+    print(Fore.CYAN+f"Valid request received from {client_address}: {request.size} bytes requested"
+          + (f" at {request.rate} bits/second" if request.rate else ""))
 
-        # Calculate the number of segments
-        segment_count = (requested_size + SEGMENT_SIZE - 1) // SEGMENT_SIZE  # Ceiling division
+    # Calculate the number of segments
+    segment_size = request_segment_size(request.segment_size)
+    segment_count = (request.size + segment_size - 1) // segment_size  # Ceiling division
+    return UdpTransfer(segment_count, segment_size, request.rate, bool(request.flags & REQUEST_FLAG_TIMESTAMPS),
+                       range(segment_count), request.size, 0)
 
-        # Send each segment to the client
-        for segment_number in range(segment_count):
-            payload = pack_payload_message(segment_count, segment_number, SEGMENT_SIZE)
-            server_socket.sendto(payload, client_address)
+class ScheduledUdpTransfer:
+    """One admitted UDP transfer in the UdpScheduler rotation."""
 
-        print(Fore.WHITE+f"Finished sending {segment_count} segments to {client_address}")
-    except Exception as e:
-        print(Fore.RED+f"Error handling UDP client {client_address}: {e}")
+    def __init__(self, transfer, client_address, sock, bandwidth):
+        self.client_address = client_address
+        self.counters = INSTRUMENTATION.transfer(client_address[0])
+        datagram_size = payload_header_size(transfer.timestamped) + transfer.segment_size
+        gso_segments = gso_batch_size(datagram_size, GSO_MAX_SEGMENTS) if UDP_GSO else 1
+        self.sender = UdpPayloadSender(sock, client_address, transfer.segment_count, transfer.segment_size,
+                                       transfer.timestamped, gso_segments, self.counters, transfer.first_sequence)
+        pacer = create_pacer(transfer.rate, UDP_DEFAULT_RATE, UDP_MAX_RATE, datagram_size, UDP_PACING_BURST)
+        self.pacer = bandwidth.open(client_address[0], pacer)
+        # A paced turn is no bigger than the pacer's burst, which is all it lets go back to back
+        self.turn_limit = max(1, self.pacer.burst // datagram_size) if self.pacer is not None else None
+        self.segments = iter(transfer.segments)
+        self.ready_at = 0.0
+        self.reserved = False
+        self.sent = 0
+
+    def send_turn(self, quantum, now):
+        """
+        Send the next quantum segments (at most turn_limit), or, if the pacer has no tokens for
+        them yet, reserve them and set ready_at to when they may go.
+
+        Returns:
+            bool: False once every segment has been sent.
+        """
+        if self.turn_limit is not None:
+            quantum = min(quantum, self.turn_limit)
+        if self.pacer is not None and not self.reserved:
+            wait = self.pacer.reserve(quantum * self.sender.datagram_size)
+            if wait > 0:
+                self.reserved = True
+                self.ready_at = now + wait
+                return True
+        self.reserved = False
+        sent = self.sender.send(islice(self.segments, quantum))
+        self.sent += sent
+        return sent == quantum
+
+class UdpScheduler:
+    """
+    Send every admitted UDP transfer from one thread, round robin.
+
+    Up to max_active transfers are in the rotation and each sends `quantum`
+    segments per turn, so one large transfer cannot starve the rest; admitted
+    transfers beyond that wait in a queue (see TransferAdmission). A transfer that
+    has to wait for tokens (its pacing rate, or the client and server caps) sits
+    out its turns instead of holding up the others.
+    """
+
+    def __init__(self, sock, admission, bandwidth, quantum=SCHEDULER_QUANTUM):
+        self.sock = sock
+        self.admission = admission
+        self.bandwidth = bandwidth
+        self.quantum = quantum
+        self.pending = deque()
+        self.condition = threading.Condition()
+
+    def submit(self, transfer, client_address):
+        """Queue a planned transfer, unless admission rejects it; returns whether it was queued."""
+        reason = self.admission.admit(transfer.size)
+        if reason:
+            print(Fore.RED+f"Rejected UDP request from {client_address}: {reason}")
+            self.sock.sendto(REJECTION_MESSAGE, client_address)
+            return False
+        with self.condition:
+            self.pending.append((transfer, client_address))
+            self.condition.notify()
+        return True
+
+    def run(self):
+        rotation = deque()
+        while True:
+            with self.condition:
+                while not rotation and not self.pending:
+                    self.condition.wait()
+                while self.pending and len(rotation) < self.admission.max_active:
+                    transfer, client_address = self.pending.popleft()
+                    self.admission.start()
+                    try:
+                        rotation.append(ScheduledUdpTransfer(transfer, client_address, self.sock, self.bandwidth))
+                    except Exception as e:
+                        print(Fore.RED+f"Error handling UDP client {client_address}: {e}")
+                        self.admission.finish()
+            if not rotation:
+                continue
+            job = rotation.popleft()
+            now = time.perf_counter()
+            if job.ready_at > now:
+                rotation.append(job)
+                earliest = min(waiting.ready_at for waiting in rotation)
+                if earliest > now:
+                    # Every transfer is waiting for tokens; a new request may still take a free place
+                    with self.condition:
+                        if not self.pending or len(rotation) >= self.admission.max_active:
+                            self.condition.wait(earliest - now)
+                continue
+            try:
+                more = job.send_turn(self.quantum, now)
+            except Exception as e:
+                print(Fore.RED+f"Error handling UDP client {job.client_address}: {e}")
+                more = False
+            if more:
+                rotation.append(job)
+            else:
+                self.finish(job)
+
+    def finish(self, job):
+        print(Fore.WHITE+f"Finished sending {job.sent} segments to {job.client_address}")
+        self.bandwidth.close(job.client_address[0])
+        self.admission.finish()
+        INSTRUMENTATION.finish(job.counters)
 
-def handle_udp_requests():
+def handle_udp_requests(addresses, controls, reuse_port=False):
     """
-    Handle incoming UDP requests from clients and respond with payload messages.
+    Receive UDP requests from clients and hand them to a UdpScheduler that sends the payloads.
     """
     # Create a UDP socket for handling client requests
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.bind(("", UDP_REQUEST_PORT))
-    print(Fore.GREEN+f"UDP server listening for requests on port {UDP_REQUEST_PORT}")
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Share the port with other workers
+    sndbuf = tune_send_buffer(server_socket, controls)
+    server_socket.bind((addresses.host, addresses.udp_port))
+    print(Fore.GREEN+f"UDP server listening for requests on port {addresses.udp_port} (send buffer {sndbuf} bytes)")
+    scheduler = UdpScheduler(server_socket, controls.udp, controls.bandwidth)
+    threading.Thread(target=scheduler.run, name="UDP-Scheduler", daemon=True).start()
 
     try:
         while True:
             # Receive a request from a client
             data, client_address = server_socket.recvfrom(1024)
             print(Fore.BLUE +f"Received UDP request from {client_address}")
-
-            # Start a new thread to handle the request
-            client_thread = threading.Thread(
-                target=handle_udp_client,
-                args=(data, client_address, server_socket),
-                daemon=True  # Mark thread as daemon so it exits when the main process ends
-            )
-            client_thread.start()
+            try:
+                transfer = plan_udp_transfer(data, client_address)
+            except ValueError:
+                print(Fore.RED+f"Invalid magic cookie or message type from {client_address}. Ignored.")
+                continue
+            scheduler.submit(transfer, client_address)
 
     except KeyboardInterrupt:
         print(Fore.RED +"Stopping UDP server...")
     finally:
         server_socket.close()
-if __name__ == "__main__":
-    set_broadcast_ip()
-    # time.sleep(3)
-    broadcast_thread = threading.Thread(target=broadcast_offers, daemon=True)
-    broadcast_thread.start()
-    print(Fore.YELLOW +"Broadcast thread started.")
+
+async def async_broadcast_offers(addresses):
+    """Broadcast offer messages via UDP from the event loop."""
+    sock = create_udp_broadcast_socket()
+    sock.setblocking(False)
+    offer_message = pack_offer_message(addresses.udp_port, addresses.tcp_port)
+
+    last_error = None
+    try:
+        while True:
+            try:
+                sock.sendto(offer_message, (addresses.broadcast_ip, addresses.broadcast_port))
+                last_error = None
+            except BlockingIOError:
+                pass  # Skip this offer, the next one follows in BROADCAST_INTERVAL
+            except OSError as e:
+                # E.g. no route to the broadcast address; keep serving and retry, reporting each new error once
+                if str(e) != last_error:
+                    print(Fore.RED+f"Error broadcasting offer: {e}")
+                    last_error = str(e)
+            await asyncio.sleep(BROADCAST_INTERVAL)
+    finally:
+        sock.close()
+
+async def async_handle_tcp_connection(reader, writer, controls):
+    """Handle a single TCP connection on the event loop."""
+    address = writer.get_extra_info("peername")
+    print(Fore.YELLOW + f"New TCP connection from {address}")
+    reason = controls.tcp.admit()
+    if reason:
+        print(Fore.RED+f"Rejected TCP connection from {address}: {reason}")
+        writer.close()
+        return
+    controls.tcp.start()
+    counters = INSTRUMENTATION.transfer(address[0])
+    pacer = controls.bandwidth.open(address[0])
+    try:
+        # An admitted connection holds a MAX_TCP_CONNECTIONS place, so it gets little time to send its request
+        first = await asyncio.wait_for(reader.read(1), TCP_REQUEST_TIMEOUT)
+        if first and not first.isdigit():
+            await async_handle_tcp_session(reader, writer, first, address, controls, counters, pacer)
+            return
+
+        # Read the requested file size
+        data = first + await asyncio.wait_for(reader.readline(), TCP_REQUEST_TIMEOUT)
+        try:
+            file_size = int(data.decode().strip())
+        except ValueError:
+            print(Fore.RED+f"Invalid TCP request {data[:32]!r} from {address}. Closed.")
+            return
+        print(Fore.CYAN+f"Client requested file size: {file_size} bytes")
+        reason = controls.tcp.check_size(file_size)
+        if reason:
+            print(Fore.RED+f"Rejected TCP request from {address}: {reason}")
+            return
+
+        # Stream the requested data, waiting for the socket to drain between chunks
+        await async_send_tcp_payload(writer, file_size, counters, pacer)
+        print(Fore.GREEN+f"Sent {file_size} bytes to {address}")
+    except asyncio.TimeoutError:
+        print(Fore.RED+f"Closed idle TCP connection from {address}")
+    except Exception as e:
+        print(Fore.RED+f"Error handling TCP connection from {address}: {e}")
+    finally:
+        controls.bandwidth.close(address[0])
+        controls.tcp.finish()
+        INSTRUMENTATION.finish(counters)
+        writer.close()
+
+async def async_send_tcp_payload(writer, file_size, counters=None, pacer=None):
+    """
+    Write file_size payload bytes, draining between chunks and waiting for the pacer's tokens if there is one.
+
+    Time spent draining counts as the send phase.
+    """
+    write = writer.write
+    if counters is None and pacer is None:
+        for chunk in iter_tcp_payload_chunks(file_size):
+            write(chunk)
+            await writer.drain()
+        return
+    clock = time.perf_counter_ns
+    for chunk in iter_tcp_payload_chunks(file_size):
+        if pacer is not None:
+            wait = pacer.reserve(len(chunk))
+            if wait > 0:
+                await asyncio.sleep(wait)
+        start = clock()
+        write(chunk)
+        await writer.drain()
+        if counters is not None:
+            counters.add("send", 1, len(chunk), clock() - start)
+
+async def async_handle_tcp_session(reader, writer, first, address, controls, counters=None, pacer=None):
+    """Answer TCP session requests until the client closes or asks for too much; `first` is the byte already read."""
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't hold back small responses
+    requests = 0
+    data = first + await asyncio.wait_for(reader.readexactly(TCP_REQUEST.size - 1), TCP_SESSION_TIMEOUT)
+    while True:
+        file_size = unpack_tcp_request(data)
+        reason = controls.tcp.check_size(file_size)
+        if reason:
+            print(Fore.RED+f"Rejected TCP session request from {address}: {reason}")
+            break
+        await async_send_tcp_payload(writer, file_size, counters, pacer)
+        requests += 1
+        try:
+            data = await asyncio.wait_for(reader.readexactly(TCP_REQUEST.size), TCP_SESSION_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            break
+    print(Fore.GREEN+f"TCP session with {address} closed after {requests} requests")
+
+class UdpRequestProtocol(asyncio.DatagramProtocol):
+    """
+    Answer UDP requests on the event loop.
+
+    Every admitted request gets its own send task, and up to max_active of them
+    send at once (the rest wait for a place). Tasks yield to the loop every
+    ASYNC_UDP_BATCH segments, which takes them round robin, and stop while the
+    transport asks to pause writing.
+    """
+
+    def __init__(self, controls):
+        self.transport = None
+        self.controls = controls
+        self.places = asyncio.Semaphore(controls.udp.max_active)
+        self.tasks = set()  # The loop only keeps weak references to tasks, so running sends are held here
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sndbuf = tune_send_buffer(transport.get_extra_info("socket"), self.controls)
+        print(Fore.GREEN+f"UDP server listening for requests on port {transport.get_extra_info('sockname')[1]}"
+                         f" (send buffer {sndbuf} bytes)")
+
+    def datagram_received(self, data, client_address):
+        print(Fore.BLUE +f"Received UDP request from {client_address}")
+        try:
+            transfer = plan_udp_transfer(data, client_address)
+        except ValueError:
+            print(Fore.RED+f"Invalid magic cookie or message type from {client_address}. Ignored.")
+            return
+        reason = self.controls.udp.admit(transfer.size)
+        if reason:
+            print(Fore.RED+f"Rejected UDP request from {client_address}: {reason}")
+            self.transport.sendto(REJECTION_MESSAGE, client_address)
+            return
+        task = asyncio.ensure_future(self.send_payloads(transfer, client_address))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def error_received(self, exc):
+        print(Fore.RED+f"UDP server error: {exc}")
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def send_payloads(self, transfer, client_address):
+        async with self.places:
+            self.controls.udp.start()
+            counters = INSTRUMENTATION.transfer(client_address[0])
+            try:
+                await self.send_transfer(transfer, client_address, counters)
+            finally:
+                self.controls.udp.finish()
+                INSTRUMENTATION.finish(counters)
+
+    async def send_transfer(self, transfer, client_address, counters):
+        bandwidth = self.controls.bandwidth
+        # The transport copies anything it has to buffer, so the template can be reused
+        template = build_payload_template(transfer.segment_count, transfer.segment_size, transfer.timestamped)
+        pacer = bandwidth.open(client_address[0], create_pacer(transfer.rate, UDP_DEFAULT_RATE, UDP_MAX_RATE,
+                                                               len(template), UDP_PACING_BURST))
+        try:
+            write_segment = timed(counters, "pack", make_segment_writer(template, transfer.timestamped))
+            sendto = timed(counters, "send", self.transport.sendto, argument_bytes)
+            sent = 0
+            sequence = transfer.first_sequence
+            for segment_number in transfer.segments:
+                if pacer is not None:
+                    wait = pacer.reserve(len(template))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                write_segment(segment_number, sequence + sent)
+                sendto(template, client_address)
+                sent += 1
+                if not self.can_write.is_set():
+                    await self.can_write.wait()
+                elif sent % ASYNC_UDP_BATCH == 0:
+                    await asyncio.sleep(0)
+
+            print(Fore.WHITE+f"Finished sending {sent} segments to {client_address}")
+        except Exception as e:
+            print(Fore.RED+f"Error handling UDP client {client_address}: {e}")
+        finally:
+            bandwidth.close(client_address[0])
+
+async def serve_async(addresses, controls, broadcast=True, reuse_port=False):
+    """Run the broadcaster, TCP listener and UDP responder on one event loop."""
+    loop = asyncio.get_running_loop()
+    tcp_server = await asyncio.start_server(functools.partial(async_handle_tcp_connection, controls=controls),
+                                            addresses.host or None, addresses.tcp_port,
+                                            backlog=MAX_CONNECTIONS, reuse_port=reuse_port)
+    udp_transport, _ = await loop.create_datagram_endpoint(lambda: UdpRequestProtocol(controls),
+                                                           local_addr=(addresses.host or "0.0.0.0",
+                                                                       addresses.udp_port),
+                                                           reuse_port=reuse_port)
+    for sock in tcp_server.sockets:
+        sndbuf = tune_send_buffer(sock, controls, tcp=True)  # Accepted connections inherit it
+    print(Fore.GREEN+f"Server started (asyncio), listening on IP address {get_own_ip()}"
+                     f" (TCP send buffer {sndbuf} bytes)")
+
+    tasks = [tcp_server.serve_forever()]
+    if broadcast:
+        tasks.append(async_broadcast_offers(addresses))
+    try:
+        async with tcp_server:
+            await asyncio.gather(*tasks)
+    finally:
+        udp_transport.close()
+
+def run_async_server(addresses, controls, broadcast=True, reuse_port=False):
+    try:
+        asyncio.run(serve_async(addresses, controls, broadcast, reuse_port))
+    except KeyboardInterrupt:
+        print(Fore.RED +"Shutting down the server...")
+
+def run_threaded_server(addresses, controls, broadcast=True, reuse_port=False):
+    if broadcast:
+        broadcast_thread = threading.Thread(target=broadcast_offers, args=(addresses,), daemon=True)
+        broadcast_thread.start()
+        print(Fore.YELLOW +"Broadcast thread started.")
 
     # Start the UDP server in a separate thread
-    udp_thread = threading.Thread(target=handle_udp_requests, daemon=True)
+    udp_thread = threading.Thread(target=handle_udp_requests, args=(addresses, controls, reuse_port), daemon=True)
     udp_thread.start()
     print(Fore.GREEN +"UDP server thread started.")
 
     # Start the TCP server in a separate thread
-    tcp_thread = threading.Thread(target=start_tcp_server, daemon=True)
+    tcp_thread = threading.Thread(target=start_tcp_server, args=(addresses, controls, reuse_port), daemon=True)
     tcp_thread.start()
     print(Fore.GREEN +"TCP server thread started.")
 
@@ -142,4 +709,110 @@ if __name__ == "__main__":
         while True:
             time.sleep(1)  # Sleep to keep the main thread running
     except KeyboardInterrupt:
-        print(Fore.RED +"Shutting down the server...")
\ No newline at end of file
+        print(Fore.RED +"Shutting down the server...")
+
+def report_stats(interval, controls):
+    """
+    Every interval seconds, print the bytes/second served per client, active transfers,
+    queue depth and rejections, and phase totals.
+    """
+    name = multiprocessing.current_process().name
+    while True:
+        time.sleep(interval)
+        active, rates, totals = INSTRUMENTATION.report()
+        print(Fore.MAGENTA+f"Stats ({name}): {active} active transfers"
+              + "".join(f", {client} {rate * 8 / 1e6:.2f} Mbps" for client, rate in sorted(rates.items()) if rate))
+        for protocol, admission in (("UDP", controls.udp), ("TCP", controls.tcp)):
+            stats = admission.stats()
+            print(Fore.MAGENTA+f"Admission ({name}) {protocol}: {stats['active']} active, {stats['queued']} queued"
+                  f" (peak {stats['peak_queued']}), {stats['admitted']} admitted, rejected {stats['rejected_busy']}"
+                  f" busy and {stats['rejected_size']} too large")
+        if totals.phases:
+            print(Fore.MAGENTA+f"Phases ({name}): {totals.format()}")
+
+def run_server(mode, broadcast=True, reuse_port=False, addresses=None, stats_interval=STATS_INTERVAL, limits=None):
+    addresses = addresses or default_addresses()
+    controls = make_controls(limits or default_limits())
+    if stats_interval:
+        INSTRUMENTATION.enabled = True  # The per-client rates come from the transfers' counters
+        threading.Thread(target=report_stats, args=(stats_interval, controls), daemon=True).start()
+    if mode == "async":
+        run_async_server(addresses, controls, broadcast, reuse_port)
+    else:
+        run_threaded_server(addresses, controls, broadcast, reuse_port)
+
+def run_workers(mode, workers, broadcast=True, addresses=None, stats_interval=STATS_INTERVAL, limits=None):
+    """
+    Run the server in several processes that share the request ports through SO_REUSEPORT.
+
+    The kernel spreads incoming connections and request datagrams across the workers;
+    only the first worker broadcasts offers (if broadcast is set). Each worker applies
+    the limits on its own.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print(Fore.RED +"SO_REUSEPORT is not supported on this platform, run with --workers 1.")
+        return
+
+    processes = []
+    for i in range(workers):
+        process = multiprocessing.Process(target=run_server, args=(mode, broadcast and i == 0, True, addresses,
+                                                                   stats_interval, limits),
+                                          name=f"Server-Worker-{i+1}")
+        process.start()
+        processes.append(process)
+    print(Fore.GREEN +f"Started {workers} server workers.")
+
+    # Turn SIGTERM into a normal exit so the workers are not left holding the ports
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print(Fore.RED +"Shutting down the server workers...")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed test server")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded",
+                        help="threaded: a thread per request (default); async: one asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the request ports (default: 1)")
+    parser.add_argument("--host", default="", help="address to listen on (default: all interfaces)")
+    parser.add_argument("--tcp-port", type=int, default=TCP_REQUEST_PORT)
+    parser.add_argument("--udp-port", type=int, default=UDP_REQUEST_PORT)
+    parser.add_argument("--broadcast-ip", help="address offers are sent to (default: this host's x.y.z.255)")
+    parser.add_argument("--broadcast-port", type=int, default=BROADCAST_PORT)
+    parser.add_argument("--no-broadcast", action="store_true", help="don't send offers")
+    parser.add_argument("--instrument", action="store_true", default=INSTRUMENT,
+                        help="count calls, bytes and time per phase of every transfer")
+    parser.add_argument("--profile", default=PROFILE_FILE, help="cProfile the first transfer into this file")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between stats reports (bytes/second per client, active transfers)")
+    parser.add_argument("--max-size", type=int, default=MAX_TRANSFER_SIZE, help="largest transfer a client may request")
+    parser.add_argument("--max-active", type=int, default=MAX_ACTIVE_TRANSFERS, help="UDP transfers sent at once")
+    parser.add_argument("--max-queued", type=int, default=MAX_QUEUED_TRANSFERS,
+                        help="UDP transfers that may wait for a place before requests are rejected")
+    parser.add_argument("--max-tcp-connections", type=int, default=MAX_TCP_CONNECTIONS)
+    parser.add_argument("--client-max-rate", type=int, default=CLIENT_MAX_RATE,
+                        help="bits/second cap per client address (0 = none)")
+    parser.add_argument("--server-max-rate", type=int, default=SERVER_MAX_RATE,
+                        help="bits/second cap over all transfers (0 = none)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    addresses = ServerAddresses(args.host, args.tcp_port, args.udp_port, set_broadcast_ip(args.broadcast_ip),
+                                args.broadcast_port)
+    limits = TransferLimits(args.max_size, args.max_active, args.max_queued, args.max_tcp_connections,
+                            args.client_max_rate, args.server_max_rate)
+    INSTRUMENTATION.configure(args.instrument, args.profile)
+    # time.sleep(3)
+    if args.workers > 1:
+        run_workers(args.mode, args.workers, not args.no_broadcast, addresses, args.stats_interval, limits)
+    else:
+        run_server(args.mode, not args.no_broadcast, addresses=addresses, stats_interval=args.stats_interval,
+                   limits=limits)
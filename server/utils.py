@@ -1,5 +1,60 @@
+import cProfile
 import socket
 import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from itertools import chain, islice
+from config import TCP_CHUNK_SIZE
+
+# One shared, read-only chunk of filler bytes; TCP payloads are streamed from it
+_TCP_PAYLOAD_CHUNK = memoryview(b'X' * TCP_CHUNK_SIZE)
+
+# Payload message layout: magic cookie, type, total segments, current segment
+PAYLOAD_HEADER = struct.Struct(">LBQQ")
+PAYLOAD_HEADER_PREFIX = struct.Struct(">LBQ")     # Everything before the current segment number
+SEGMENT_NUMBER = struct.Struct(">Q")
+SEGMENT_NUMBER_OFFSET = PAYLOAD_HEADER_PREFIX.size
+
+# Timestamped payload messages (type 0x5) follow the segment number with a sequence number
+# (send order within the transfer) and the server's monotonic send time in nanoseconds.
+# Retransmissions for a NACK are numbered from the transfer's segment count up, so the
+# client can leave them out of its reordering statistics
+TIMESTAMPED_FIELDS = struct.Struct(">QQQ")        # Current segment, sequence number, send time
+TIMESTAMPED_HEADER_SIZE = SEGMENT_NUMBER_OFFSET + TIMESTAMPED_FIELDS.size
+
+# Request message layout: magic cookie, type, requested file size, then optional fields in order
+UDP_REQUEST = struct.Struct(">LBQ")
+UDP_REQUEST_OPTIONS = (("rate", struct.Struct(">Q")), ("flags", struct.Struct(">B")),
+                       ("segment_size", struct.Struct(">I")))
+REQUEST_FLAG_TIMESTAMPS = 0x1                     # Client wants timestamped payload messages
+REQUEST_FLAG_RELIABLE = 0x2                       # Client will send NACKs for missing segments
+
+UdpRequest = namedtuple("UdpRequest", ["size", "rate", "flags", "segment_size"])
+
+# NACK message layout (type 0x6): magic cookie, type, total segments, segment size, rate, flags,
+# range count, then (first segment, segment count) per missing range
+NACK_HEADER = struct.Struct(">LBQIQBH")
+NACK_RANGE = struct.Struct(">QI")
+
+# Rejection message (type 0x8): magic cookie and type, the answer to a UDP request that is not admitted
+REJECTION_MESSAGE = struct.pack(">LB", 0xabcddcba, 0x8)
+
+Nack = namedtuple("Nack", ["total_segments", "segment_size", "rate", "flags", "ranges"])
+
+# TCP session request (type 0x7): magic cookie, type, requested size. A connection whose first
+# byte is not a digit is a session: any number of these, each answered with exactly `size` bytes
+TCP_REQUEST = struct.Struct(">LBQ")
+
+# Linux UDP generic segmentation offload: one sendmsg carries many equal-sized datagrams
+GSO_SUPPORTED = sys.platform.startswith("linux")
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+GSO_MAX_BYTES = 65000                             # Stay below the 64 KB limit on one GSO send
+
+WMEM_MAX_FILE = "/proc/sys/net/core/wmem_max"   # Largest SO_SNDBUF a request gets; bigger ones are cut down silently
+TCP_WMEM_FILE = "/proc/sys/net/ipv4/tcp_wmem"   # min, default and max send buffer of autotuned TCP sockets
+SNDBUF_REPORT_FACTOR = 2 if sys.platform.startswith("linux") else 1  # getsockopt shows Linux's doubled SO_SNDBUF
 
 def create_udp_broadcast_socket():
     """Create and return a UDP socket configured for broadcasting."""
@@ -19,6 +74,95 @@ def pack_offer_message(udp_port, tcp_port):
     """
     return struct.pack(">LBHH", 0xabcddcba, 0x2, udp_port, tcp_port)
 
+def unpack_udp_request(data):
+    """
+    Unpack a UDP request message from a client and validate its structure.
+
+    Format:
+    - Magic cookie (4 bytes): 0xabcddcba
+    - Message type (1 byte): 0x3 (request)
+    - File size (8 bytes): The requested file size, in bytes.
+    Optional fields, each present only if all fields before it are:
+    - Rate (8 bytes): The requested sending rate, in bits/second (0 = server default).
+    - Flags (1 byte): REQUEST_FLAG_* bits.
+    - Segment size (4 bytes): The requested payload bytes per segment (0 = server default).
+
+    Returns:
+        UdpRequest: The requested size and options (0 for options the client did not send).
+    """
+    if len(data) < UDP_REQUEST.size:
+        raise ValueError("Request message too short")
+    magic_cookie, message_type, requested_size = UDP_REQUEST.unpack_from(data)
+    if magic_cookie != 0xabcddcba or message_type != 0x3:
+        raise ValueError("Invalid magic cookie or message type")
+    options = {}
+    offset = UDP_REQUEST.size
+    for name, field in UDP_REQUEST_OPTIONS:
+        if len(data) < offset + field.size:
+            break
+        options[name], = field.unpack_from(data, offset)
+        offset += field.size
+    return UdpRequest(requested_size, options.get("rate", 0), options.get("flags", 0),
+                      options.get("segment_size", 0))
+
+def unpack_tcp_request(data):
+    """
+    Unpack a TCP session request and validate it.
+
+    Returns:
+        int: The requested size, in bytes.
+    """
+    magic_cookie, message_type, requested_size = TCP_REQUEST.unpack(data)
+    if magic_cookie != 0xabcddcba or message_type != 0x7:
+        raise ValueError("Invalid magic cookie or message type")
+    return requested_size
+
+def recv_exact(sock, size):
+    """
+    Read exactly size bytes from a TCP socket.
+
+    Returns:
+        bytes: The data, or b'' if the peer closed the connection before sending any of it.
+    """
+    data = b''
+    while len(data) < size:
+        piece = sock.recv(size - len(data))
+        if not piece:
+            if data:
+                raise ConnectionError("Connection closed in the middle of a request")
+            return b''
+        data += piece
+    return data
+
+def unpack_nack(data):
+    """
+    Unpack a NACK message listing segment ranges a reliable-mode client is missing.
+
+    The message repeats the transfer parameters, so the server needs no state to
+    retransmit. Ranges are clipped to the transfer's segment count.
+
+    Returns:
+        Nack: The transfer parameters and a list of (first segment, segment count) ranges.
+    """
+    if len(data) < NACK_HEADER.size:
+        raise ValueError("NACK message too short")
+    magic_cookie, message_type, total_segments, segment_size, rate, flags, range_count = NACK_HEADER.unpack_from(data)
+    if magic_cookie != 0xabcddcba or message_type != 0x6:
+        raise ValueError("Invalid magic cookie or message type")
+    if len(data) < NACK_HEADER.size + range_count * NACK_RANGE.size:
+        raise ValueError("NACK message truncated")
+    ranges = []
+    for i in range(range_count):
+        first, count = NACK_RANGE.unpack_from(data, NACK_HEADER.size + i * NACK_RANGE.size)
+        count = min(count, total_segments - first) if first < total_segments else 0
+        if count > 0:
+            ranges.append((first, count))
+    return Nack(total_segments, segment_size, rate, flags, ranges)
+
+def iter_nack_segments(ranges):
+    """Yield every segment number covered by a list of (first, count) ranges."""
+    return chain.from_iterable(range(first, first + count) for first, count in ranges)
+
 def pack_payload_message(segment_count, current_segment, payload_size):
     """
     Pack a payload message into the specified binary format.
@@ -39,4 +183,398 @@ def pack_payload_message(segment_count, current_segment, payload_size):
     # Generate dummy payload data of the specified size
     payload_data = b'X' * payload_size  # 'X' is a placeholder byte
 
-    return header + payload_data
\ No newline at end of file
+    return header + payload_data
+
+def payload_header_size(timestamped=False):
+    """Size of a payload message header: 21 bytes, or 37 for a timestamped message."""
+    return TIMESTAMPED_HEADER_SIZE if timestamped else PAYLOAD_HEADER.size
+
+def build_payload_template(segment_count, payload_size, timestamped=False):
+    """
+    Build a reusable payload datagram with everything but the per-segment fields filled in.
+
+    The layout matches pack_payload_message; only the current segment number field
+    (at SEGMENT_NUMBER_OFFSET) changes between segments of one transfer. A timestamped
+    template (type 0x5) also leaves room for the sequence number and send time.
+    """
+    header_size = payload_header_size(timestamped)
+    template = bytearray(header_size + payload_size)
+    PAYLOAD_HEADER_PREFIX.pack_into(template, 0, 0xabcddcba, 0x5 if timestamped else 0x4, segment_count)
+    template[header_size:] = b'X' * payload_size
+    return template
+
+def make_segment_writer(buffer, timestamped=False):
+    """
+    Return a function (segment_number, sequence, base=0) that fills in the per-segment
+    fields of the datagram starting at offset base of buffer, in place; timestamped
+    datagrams also get the current send time.
+    """
+    if not timestamped:
+        pack_segment_number = SEGMENT_NUMBER.pack_into
+        return lambda segment_number, sequence, base=0: pack_segment_number(
+            buffer, base + SEGMENT_NUMBER_OFFSET, segment_number)
+    pack_fields = TIMESTAMPED_FIELDS.pack_into
+    clock = time.perf_counter_ns
+    return lambda segment_number, sequence, base=0: pack_fields(
+        buffer, base + SEGMENT_NUMBER_OFFSET, segment_number, sequence, clock())
+
+def gso_batch_size(datagram_size, max_segments):
+    """Number of datagrams to send per GSO call (1 means GSO would not help)."""
+    if not GSO_SUPPORTED:
+        return 1
+    return max(1, min(max_segments, GSO_MAX_BYTES // datagram_size))
+
+def read_proc_value(path, field=0):
+    """Parse a kernel setting from /proc; None if the file is missing (other platforms) or malformed."""
+    try:
+        with open(path) as f:
+            return int(f.read().split()[field])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def set_send_buffer(sock, wanted, tcp=False):
+    """
+    Let sock queue up to wanted bytes of unsent data (SO_SNDBUF), within wmem_max.
+
+    A listening TCP socket is left alone if the tcp_wmem maximum already covers wanted:
+    accepted connections inherit a fixed SO_SNDBUF and would lose send-side autotuning.
+
+    Returns:
+        int: The SO_SNDBUF now in effect (the kernel doubles what is set for its own overhead).
+    """
+    limit = read_proc_value(WMEM_MAX_FILE)
+    if limit is not None:
+        wanted = min(wanted, limit)
+    autotune = read_proc_value(TCP_WMEM_FILE, 2) if tcp else None
+    current = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // SNDBUF_REPORT_FACTOR
+    if wanted > current and (autotune is None or wanted > autotune):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, wanted)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+def send_udp_payloads(sock, client_address, segment_count, payload_size, pacer=None, timestamped=False,
+                      gso_segments=1, segments=None, counters=None, first_sequence=0):
+    """
+    Send payload messages for `segments` (default: all segment_count of them) to client_address.
+
+    The whole transfer goes out in one call; see UdpPayloadSender.
+
+    Returns:
+        int: Number of segments sent.
+    """
+    if segments is None:
+        segments = range(segment_count)
+    sender = UdpPayloadSender(sock, client_address, segment_count, payload_size, timestamped, gso_segments, counters,
+                              first_sequence)
+    return sender.send(segments, pacer)
+
+class UdpPayloadSender:
+    """
+    Send the payload messages of one transfer, as many segments per call as asked.
+
+    One datagram template is allocated per transfer and the per-segment fields are
+    written into it in place, so sending does not allocate. With gso_segments > 1
+    (see gso_batch_size) datagrams go out in batches through UDP GSO, falling back to
+    one sendto per datagram if the kernel refuses. If a TokenBucket is given as pacer,
+    sending is held to its rate. With PhaseCounters, the pack, send and pace phases
+    are counted. Datagrams carry a sequence number counting up from first_sequence
+    in send order, across calls to send().
+    """
+
+    def __init__(self, sock, client_address, segment_count, payload_size, timestamped=False, gso_segments=1,
+                 counters=None, first_sequence=0):
+        self.client_address = client_address
+        self.sequence = first_sequence
+        self.template = build_payload_template(segment_count, payload_size, timestamped)
+        self.datagram_size = len(self.template)
+        self.write_segment = timed(counters, "pack", make_segment_writer(self.template, timestamped))
+        self.sendto = timed(counters, "send", sock.sendto, result_bytes)
+        self.sleep = timed(counters, "pace", time.sleep)
+        self.gso_segments = gso_segments
+        if gso_segments > 1:
+            batch_buffer = bytearray(self.template * gso_segments)
+            self.batch_view = memoryview(batch_buffer)
+            self.write_batch_segment = timed(counters, "pack", make_segment_writer(batch_buffer, timestamped))
+            self.gso_control = [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", self.datagram_size))]
+            self.sendmsg = timed(counters, "send", sock.sendmsg, result_bytes)
+
+    def send(self, segments, pacer=None):
+        """
+        Send the given segment numbers.
+
+        Returns:
+            int: Number of segments sent.
+        """
+        sent = 0
+        if self.gso_segments > 1:
+            sent, segments = self._send_gso(segments, pacer)
+        write_segment = self.write_segment
+        sendto = self.sendto
+        template = self.template
+        client_address = self.client_address
+        sequence = self.sequence - sent  # Segments sent through GSO already advanced self.sequence
+        if pacer is None:
+            for segment_number in segments:
+                write_segment(segment_number, sequence + sent)
+                sendto(template, client_address)
+                sent += 1
+            self.sequence = sequence + sent
+            return sent
+
+        datagram_size = self.datagram_size
+        reserve = pacer.reserve
+        sleep = self.sleep
+        for segment_number in segments:
+            wait = reserve(datagram_size)
+            if wait > 0:
+                sleep(wait)
+            write_segment(segment_number, sequence + sent)
+            sendto(template, client_address)
+            sent += 1
+        self.sequence = sequence + sent
+        return sent
+
+    def _send_gso(self, segments, pacer):
+        """
+        Send the segments in batches of gso_segments datagrams, one sendmsg with UDP_SEGMENT each.
+
+        Returns:
+            tuple: Segments sent, and an iterator over the segments still to send, which is
+            empty unless GSO failed part way.
+        """
+        datagram_size = self.datagram_size
+        batch = self.gso_segments
+        view = self.batch_view
+        write_segment = self.write_batch_segment
+        control = self.gso_control
+        sendmsg = self.sendmsg
+        client_address = self.client_address
+        remaining = iter(segments)
+        sent = 0
+        while True:
+            numbers = list(islice(remaining, batch))
+            if not numbers:
+                return sent, remaining
+            if pacer is not None:
+                wait = pacer.reserve(len(numbers) * datagram_size)
+                if wait > 0:
+                    self.sleep(wait)
+            for k, segment_number in enumerate(numbers):
+                write_segment(segment_number, self.sequence + k, k * datagram_size)
+            try:
+                sendmsg((view[:len(numbers) * datagram_size],), control, 0, client_address)
+            except OSError:
+                self.gso_segments = 1  # No GSO on this path; send this and later segments one by one
+                return sent, chain(numbers, remaining)
+            sent += len(numbers)
+            self.sequence += len(numbers)
+
+class TokenBucket:
+    """
+    Token bucket used to pace one transfer.
+
+    Tokens are bytes; they refill at rate_bps / 8 per second, up to burst_bytes.
+    """
+
+    def __init__(self, rate_bps, burst_bytes):
+        self.rate = rate_bps / 8
+        self.burst = burst_bytes
+        self.tokens = burst_bytes
+        self.last_refill = time.perf_counter()
+
+    def reserve(self, amount):
+        """
+        Take amount tokens from the bucket.
+
+        Returns:
+            float: Seconds the caller should wait before sending (0 if it may send now).
+        """
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+def create_pacer(requested_rate, default_rate, max_rate, datagram_size, burst_segments):
+    """
+    Choose the pacing rate for a transfer and build its TokenBucket.
+
+    The client's requested rate wins over the server default, and is capped by
+    max_rate when one is set. Returns None for an unpaced transfer.
+    """
+    rate = requested_rate or default_rate
+    if max_rate:
+        rate = min(rate, max_rate) if rate else max_rate
+    if not rate:
+        return None
+    return TokenBucket(rate, datagram_size * burst_segments)
+
+def send_tcp_payload(sock, total_size, chunk=_TCP_PAYLOAD_CHUNK, counters=None, pacer=None):
+    """
+    Stream a payload of 'X' bytes over a connected TCP socket.
+
+    The data is sent from one preallocated chunk (sliced through a memoryview, so
+    nothing is copied), which keeps memory use constant regardless of total_size.
+    If a pacer is given, every chunk waits for its tokens first.
+
+    Returns:
+        int: Number of bytes sent.
+    """
+    sendall = timed(counters, "send", sock.sendall, argument_bytes)
+    if pacer is None:
+        for piece in iter_tcp_payload_chunks(total_size, chunk):
+            sendall(piece)
+        return total_size
+
+    sleep = timed(counters, "pace", time.sleep)
+    for piece in iter_tcp_payload_chunks(total_size, chunk):
+        wait = pacer.reserve(len(piece))
+        if wait > 0:
+            sleep(wait)
+        sendall(piece)
+    return total_size
+
+def iter_tcp_payload_chunks(total_size, chunk=_TCP_PAYLOAD_CHUNK):
+    """Yield views of the shared payload chunk that together add up to total_size bytes."""
+    chunk_size = len(chunk)
+    remaining = total_size
+    while remaining >= chunk_size:
+        yield chunk
+        remaining -= chunk_size
+    if remaining:
+        yield chunk[:remaining]
+
+def result_bytes(result, args):
+    """Bytes moved by a send/recv call that returns its byte count."""
+    return result
+
+def argument_bytes(result, args):
+    """Bytes moved by a call that sends all of its first argument (sendall)."""
+    return len(args[0])
+
+class PhaseCounters:
+    """
+    Calls, bytes and time per phase (send, pack, pace, ...) of one transfer.
+
+    Only built while instrumentation is on. Send loops wrap the functions they call
+    with timed() once, before the loop, and timed() hands back the function itself
+    when there are no counters, so a loop without instrumentation is unchanged.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self.phases = {}  # Phase name -> [calls, bytes, nanoseconds]
+        self.profile = None
+        self.reported_bytes = 0  # Sent bytes already counted in a stats report
+
+    def wrap(self, phase, function, size=None):
+        """Return function timed and counted under phase; size(result, args) gives the bytes per call."""
+        counts = self.phases.setdefault(phase, [0, 0, 0])
+        clock = time.perf_counter_ns
+
+        def timed_function(*args):
+            start = clock()
+            result = function(*args)
+            counts[2] += clock() - start
+            counts[0] += 1
+            if size is not None:
+                counts[1] += size(result, args)
+            return result
+        return timed_function
+
+    def add(self, phase, calls, nbytes, nanoseconds):
+        counts = self.phases.setdefault(phase, [0, 0, 0])
+        counts[0] += calls
+        counts[1] += nbytes
+        counts[2] += nanoseconds
+
+    def merge(self, other):
+        for phase, (calls, nbytes, nanoseconds) in other.phases.items():
+            self.add(phase, calls, nbytes, nanoseconds)
+
+    def bytes_sent(self):
+        return self.phases["send"][1] if "send" in self.phases else 0
+
+    def format(self):
+        """One line: calls, bytes per call and seconds for every phase."""
+        return ", ".join(f"{phase} {calls} calls {nbytes / calls if calls else 0:.0f} B/call {nanoseconds / 1e9:.3f} s"
+                         for phase, (calls, nbytes, nanoseconds) in sorted(self.phases.items()) if calls)
+
+def timed(counters, phase, function, size=None):
+    """counters.wrap(phase, function, size), or function itself when counters is None (instrumentation off)."""
+    return function if counters is None else counters.wrap(phase, function, size)
+
+class Instrumentation:
+    """
+    The process-wide switch for per-phase counters, profiling and stats reports.
+
+    transfer() hands out the PhaseCounters for one transfer (None while off) and,
+    if a profile file is set, profiles the first transfer with cProfile; finish()
+    stops that and adds the counters to the totals. report() gives the bytes/second
+    sent to each client since the last report.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_path = None
+        self.profile_taken = False
+        self.totals = PhaseCounters()
+        self.active = set()
+        self.finished_bytes = {}  # Client -> bytes sent by transfers that finished since the last report
+        self.last_report = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=False, profile_path=None):
+        self.enabled = enabled or bool(profile_path)
+        self.profile_path = profile_path
+
+    def transfer(self, client=None):
+        if not self.enabled:
+            return None
+        counters = PhaseCounters(client)
+        with self.lock:
+            self.active.add(counters)
+            if self.profile_path and not self.profile_taken:
+                self.profile_taken = True
+                counters.profile = cProfile.Profile()
+        if counters.profile:
+            counters.profile.enable()  # Profiles the calling thread only
+        return counters
+
+    def finish(self, counters):
+        if counters is None:
+            return
+        if counters.profile:
+            counters.profile.disable()
+            counters.profile.dump_stats(self.profile_path)
+            print(f"Profile of one transfer to {counters.client} written to {self.profile_path}"
+                  f" (view it with: python -m pstats {self.profile_path})")
+        with self.lock:
+            self.active.discard(counters)
+            self.totals.merge(counters)
+            sent = counters.bytes_sent() - counters.reported_bytes
+            self.finished_bytes[counters.client] = self.finished_bytes.get(counters.client, 0) + sent
+
+    def report(self):
+        """
+        Returns:
+            tuple: Active transfer count, {client: bytes/second sent since the last report},
+            and the phase totals of the finished transfers so far.
+        """
+        with self.lock:
+            per_client = self.finished_bytes
+            self.finished_bytes = {}
+            for counters in self.active:
+                sent = counters.bytes_sent()
+                per_client[counters.client] = per_client.get(counters.client, 0) + sent - counters.reported_bytes
+                counters.reported_bytes = sent
+            totals = PhaseCounters()
+            totals.merge(self.totals)
+            active = len(self.active)
+            now = time.perf_counter()
+            elapsed = now - self.last_report
+            self.last_report = now
+        return active, {client: sent / elapsed for client, sent in per_client.items()}, totals
+
+INSTRUMENTATION = Instrumentation()
@@ -0,0 +1,44 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(side, name="utils"):
+    """
+    Import client/<name>.py or server/<name>.py under its own name, e.g. client_utils.
+
+    Both programs have a config.py and a utils.py of their own, so each is loaded
+    with its directory on the path and the other side's modules out of sys.modules.
+    """
+    directory = os.path.join(ROOT, side)
+    saved = {module: sys.modules.pop(module) for module in ("config", "utils") if module in sys.modules}
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{side}_{name}", os.path.join(directory, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        sys.modules.pop("config", None)
+        sys.modules.pop("utils", None)
+        sys.modules.update(saved)
+    return module
+
+
+@pytest.fixture(scope="session")
+def client_utils():
+    return load_module("client")
+
+
+@pytest.fixture(scope="session")
+def server_utils():
+    return load_module("server")
+
+
+@pytest.fixture(scope="session")
+def server_module():
+    return load_module("server", "server")
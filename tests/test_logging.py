@@ -0,0 +1,26 @@
+import logging
+import queue
+
+
+def test_dropping_queue_handler_counts_what_does_not_fit(client_utils):
+    log_queue = queue.Queue(maxsize=2)
+    handler = client_utils.DroppingQueueHandler(log_queue)
+    logger = logging.Logger("test-dropping-queue")
+    logger.addHandler(handler)
+    for n in range(5):
+        logger.info("record %d", n)
+    assert handler.dropped == 3
+    assert [log_queue.get_nowait().getMessage() for _ in range(2)] == ["record 0", "record 1"]
+
+
+def test_dropping_queue_handler_keeps_filtered_records_out(client_utils):
+    log_queue = queue.Queue(maxsize=2)
+    handler = client_utils.DroppingQueueHandler(log_queue)
+    handler.addFilter(lambda record: record.levelno >= logging.WARNING)
+    logger = logging.Logger("test-dropping-queue-filter")
+    logger.addHandler(handler)
+    logger.info("skipped")
+    logger.warning("kept")
+    assert handler.dropped == 0
+    assert log_queue.get_nowait().getMessage() == "kept"
+    assert log_queue.empty()
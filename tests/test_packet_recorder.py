@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+
+def recorder_with(client_utils, packets):
+    """packets: (sequence, segment, send_ns, receive_ns) in arrival order, 100 payload bytes each."""
+    recorder = client_utils.PacketRecorder()
+    for sequence, segment, send_ns, receive_ns in packets:
+        recorder.sequences.append(sequence)
+        recorder.segments.append(segment)
+        recorder.send_ns.append(send_ns)
+        recorder.receive_ns.append(receive_ns)
+        recorder.sizes.append(100)
+    return recorder
+
+
+def test_analyze_empty(client_utils):
+    assert client_utils.PacketRecorder().analyze() == {}
+
+
+def test_analyze_in_order(client_utils):
+    stats = recorder_with(client_utils, [(n, n, n * 1000, n * 1000 + 500) for n in range(10)]).analyze(10)
+    assert stats["reordered"] == 0
+    assert stats["max_reorder_depth"] == 0
+    assert stats["duplicates"] == 0
+    assert stats["payload_bytes"] == 1000
+    assert stats["delay_max_ms"] == 0
+    assert stats["jitter_ms"] == 0
+
+
+def test_analyze_reordering_and_duplicates(client_utils):
+    order = [0, 3, 1, 2, 3, 4]
+    stats = recorder_with(client_utils, [(n, n, 0, 0) for n in order]).analyze(5)
+    assert stats["reordered"] == 2
+    assert stats["max_reorder_depth"] == 2
+    assert stats["duplicates"] == 1
+    assert stats["payload_bytes"] == 500
+
+
+def test_analyze_leaves_retransmissions_out_of_reordering(client_utils):
+    # Segments 1 and 2 were lost and resent for a NACK, numbered from total_segments up
+    packets = [(0, 0), (3, 3), (4, 4), (5, 2), (6, 1), (7, 3)]
+    stats = recorder_with(client_utils, [(sequence, segment, 0, 0) for sequence, segment in packets]).analyze(5)
+    assert stats["reordered"] == 0
+    assert stats["duplicates"] == 1
+    assert stats["payload_bytes"] == 500
+
+
+def test_analyze_relative_delay(client_utils):
+    stats = recorder_with(client_utils, [(0, 0, 0, 1000000), (1, 1, 0, 3000000)]).analyze(2)
+    assert stats["delay_mean_ms"] == pytest.approx(1.0)
+    assert stats["delay_max_ms"] == pytest.approx(2.0)
+    assert stats["jitter_ms"] == pytest.approx(2.0 / 16)
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+
+def tracker_with(client_utils, total_segments, received):
+    tracker = client_utils.SegmentTracker(total_segments)
+    for segment in received:
+        tracker.add(segment)
+    return tracker
+
+
+def expected_ranges(total_segments, received, merge_gap=0):
+    """Missing ranges computed the slow way, one segment at a time."""
+    ranges = []
+    for segment in range(total_segments):
+        if segment in received:
+            continue
+        if ranges and segment - (ranges[-1][0] + ranges[-1][1]) <= merge_gap:
+            ranges[-1][1] = segment + 1 - ranges[-1][0]
+        else:
+            ranges.append([segment, 1])
+    return [tuple(r) for r in ranges]
+
+
+def test_missing_ranges_nothing_received(client_utils):
+    assert tracker_with(client_utils, 20, []).missing_ranges() == [(0, 20)]
+
+
+def test_missing_ranges_everything_received(client_utils):
+    assert tracker_with(client_utils, 20, range(20)).missing_ranges() == []
+
+
+def test_missing_ranges_no_segments(client_utils):
+    assert tracker_with(client_utils, 0, []).missing_ranges() == []
+
+
+@pytest.mark.parametrize("total_segments", [9, 13, 15])
+def test_missing_ranges_partial_last_byte(client_utils, total_segments):
+    # The unused high bits of the last bitmap byte must not be reported as missing
+    tracker = tracker_with(client_utils, total_segments, range(8))
+    assert tracker.missing_ranges() == [(8, total_segments - 8)]
+    tracker = tracker_with(client_utils, total_segments, range(total_segments - 1))
+    assert tracker.missing_ranges() == [(total_segments - 1, 1)]
+
+
+def test_missing_ranges_merge_gap(client_utils):
+    received = {2, 3, 10, 11, 12, 13, 14}
+    tracker = tracker_with(client_utils, 16, received)
+    assert tracker.missing_ranges() == [(0, 2), (4, 6), (15, 1)]
+    assert tracker.missing_ranges(merge_gap=2) == [(0, 10), (15, 1)]
+    assert tracker.missing_ranges(merge_gap=5) == [(0, 16)]
+
+
+def test_missing_ranges_random(client_utils):
+    rng = random.Random(7)
+    for _ in range(200):
+        total_segments = rng.randrange(1, 200)
+        received = {s for s in range(total_segments) if rng.random() < rng.random()}
+        merge_gap = rng.choice((0, 0, 1, 4))
+        tracker = tracker_with(client_utils, total_segments, received)
+        assert tracker.missing_ranges(merge_gap) == expected_ranges(total_segments, received, merge_gap)
+
+
+def test_nack_round_trip(client_utils, server_utils):
+    ranges = [(i * 10, 3) for i in range(7)]
+    messages = client_utils.pack_nack_messages(100, 1400, 5000000, 0x3, ranges, max_ranges=3)
+    assert len(messages) == 3
+    decoded = [server_utils.unpack_nack(bytes(message)) for message in messages]
+    assert all((n.total_segments, n.segment_size, n.rate, n.flags) == (100, 1400, 5000000, 0x3) for n in decoded)
+    assert [r for n in decoded for r in n.ranges] == ranges
+    assert list(server_utils.iter_nack_segments(decoded[0].ranges)) == [0, 1, 2, 10, 11, 12, 20, 21, 22]
+
+
+def test_nack_ranges_clipped_to_transfer(client_utils, server_utils):
+    message, = client_utils.pack_nack_messages(10, 512, 0, 0, [(8, 5), (12, 1)])
+    assert server_utils.unpack_nack(bytes(message)).ranges == [(8, 2)]
+
+
+def test_nack_rejects_bad_messages(client_utils, server_utils):
+    message, = client_utils.pack_nack_messages(10, 512, 0, 0, [(0, 1), (4, 2)])
+    with pytest.raises(ValueError):
+        server_utils.unpack_nack(bytes(message[:-1]))
+    with pytest.raises(ValueError):
+        server_utils.unpack_nack(b"\xab\xcd\xdc\xba\x03" + bytes(message[5:]))
+
+
+@pytest.mark.parametrize("rate, flags, segment_size", [
+    (0, 0, 0), (10000000, 0, 0), (0, 0x1, 0), (0, 0, 1400), (10000000, 0x3, 9000),
+])
+def test_udp_request_optional_fields_round_trip(client_utils, server_utils, rate, flags, segment_size):
+    message = client_utils.pack_udp_request(1 << 20, rate, flags, segment_size)
+    assert server_utils.unpack_udp_request(message) == (1 << 20, rate, flags, segment_size)
+
+
+def test_udp_request_sends_only_fields_that_are_set(client_utils, server_utils):
+    assert len(client_utils.pack_udp_request(1024)) == server_utils.UDP_REQUEST.size
+    assert len(client_utils.pack_udp_request(1024, flags=0x1)) == server_utils.UDP_REQUEST.size + 8 + 1
@@ -0,0 +1,63 @@
+import socket
+
+import pytest
+
+
+class FakeSocket:
+    """Reports twice the buffer size that was set, as Linux does."""
+
+    def __init__(self, size):
+        self.size = size
+        self.set_calls = []
+
+    def getsockopt(self, level, option):
+        return self.size * 2
+
+    def setsockopt(self, level, option, value):
+        self.set_calls.append((option, value))
+        self.size = value
+
+
+@pytest.fixture(params=[("client", "set_receive_buffer", "RCVBUF_REPORT_FACTOR", socket.SO_RCVBUF),
+                        ("server", "set_send_buffer", "SNDBUF_REPORT_FACTOR", socket.SO_SNDBUF)],
+                ids=["client", "server"])
+def set_buffer(request, monkeypatch):
+    """One side's buffer setter as on Linux, reading /proc settings from the returned dict (by file name)."""
+    side, name, factor, option = request.param
+    module = request.getfixturevalue(f"{side}_utils")
+    proc = {}
+    monkeypatch.setattr(module, factor, 2)
+    monkeypatch.setattr(module, "read_proc_value", lambda path, field=0: proc.get(path.rsplit("/", 1)[-1]))
+    return getattr(module, name), option, proc
+
+
+def test_grows_buffer_between_half_and_wanted(set_buffer):
+    set_buffer_size, option, _ = set_buffer
+    sock = FakeSocket(150000)  # Reported as 300000, more than wanted, yet smaller than it
+    assert set_buffer_size(sock, 200000) == 400000
+    assert sock.set_calls == [(option, 200000)]
+
+
+def test_never_shrinks_buffer(set_buffer):
+    set_buffer_size, _, _ = set_buffer
+    sock = FakeSocket(250000)
+    assert set_buffer_size(sock, 200000) == 500000
+    assert sock.set_calls == []
+
+
+def test_capped_by_system_limit(set_buffer):
+    set_buffer_size, option, proc = set_buffer
+    proc.update(rmem_max=100000, wmem_max=100000)
+    sock = FakeSocket(50000)
+    set_buffer_size(sock, 200000)
+    assert sock.set_calls == [(option, 100000)]
+
+
+def test_tcp_left_to_autotuning(set_buffer):
+    set_buffer_size, option, proc = set_buffer
+    proc.update(tcp_rmem=6291456, tcp_wmem=4194304)
+    sock = FakeSocket(65536)
+    set_buffer_size(sock, 1000000, tcp=True)
+    assert sock.set_calls == []
+    set_buffer_size(sock, 8000000, tcp=True)
+    assert sock.set_calls == [(option, 8000000)]
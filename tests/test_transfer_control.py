@@ -0,0 +1,100 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self):
+        return self.now
+
+
+class RecordingSocket:
+    """Stands in for the server's UDP socket, recording whom each datagram went to."""
+
+    def __init__(self, expected):
+        self.destinations = []
+        self.done = threading.Event()
+        self.expected = expected
+
+    def sendto(self, data, address):
+        self.destinations.append(address)
+        if len(self.destinations) >= self.expected:
+            self.done.set()
+        return len(data)
+
+    def sendmsg(self, buffers, control, flags, address):
+        raise OSError("no GSO here")
+
+
+def test_admission_active_and_queued_limits(server_module):
+    admission = server_module.TransferAdmission(max_size=1000, max_active=1, max_queued=1)
+    assert admission.admit(100) is None
+    admission.start()
+    assert admission.admit(100) is None
+    assert admission.admit(100) == "1 transfers active and 1 queued"
+    admission.finish()
+    admission.start()
+    assert admission.stats() == {"active": 1, "queued": 0, "peak_queued": 1, "admitted": 2,
+                                 "rejected_busy": 1, "rejected_size": 0}
+    assert admission.admit(100) is None
+
+
+def test_admission_rejects_oversized_requests(server_module):
+    admission = server_module.TransferAdmission(max_size=1000, max_active=4)
+    assert admission.admit(1001) == "1001 bytes is over the 1000-byte limit"
+    assert admission.admit(1000) is None
+    assert admission.stats()["rejected_size"] == 1
+
+
+def test_token_bucket_holds_rate_after_burst(server_utils, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server_utils, "time", SimpleNamespace(perf_counter=clock.perf_counter))
+    bucket = server_utils.TokenBucket(8000, 500)  # 1000 bytes/second, 500 back to back
+    start = clock.now
+    for _ in range(25):
+        clock.now += bucket.reserve(100)
+    # The first 500 bytes go at once, the other 2000 at the rate
+    assert clock.now - start == pytest.approx(2.0)
+    assert bucket.reserve(100) > 0
+
+
+def test_token_bucket_refills_up_to_burst(server_utils, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server_utils, "time", SimpleNamespace(perf_counter=clock.perf_counter))
+    bucket = server_utils.TokenBucket(8000, 500)
+    assert bucket.reserve(500) == 0
+    clock.now += 60  # Idle time beyond the burst is not saved up
+    assert bucket.reserve(500) == 0
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+
+def test_scheduler_takes_transfers_round_robin(server_module, monkeypatch):
+    monkeypatch.setattr(server_module, "UDP_GSO", False)
+    clients = [("10.0.0.1", 1001), ("10.0.0.2", 1002), ("10.0.0.3", 1003)]
+    sock = RecordingSocket(expected=4 * len(clients))
+    admission = server_module.TransferAdmission(max_size=1 << 20, max_active=len(clients))
+    scheduler = server_module.UdpScheduler(sock, admission, server_module.BandwidthLimits(0, 0), quantum=2)
+    for client in clients:
+        transfer = server_module.UdpTransfer(4, 100, 0, False, range(4), 400, 0)
+        assert scheduler.submit(transfer, client)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    assert sock.done.wait(5)
+    deadline = time.time() + 5
+    while admission.stats()["active"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert sock.destinations == [client for client in clients for _ in range(2)] * 2
+    assert admission.stats()["active"] == 0
+
+
+def test_scheduler_turn_stays_within_pacing_burst(server_module):
+    bandwidth = server_module.BandwidthLimits(client_rate=8000000, server_rate=0, burst_bytes=250)
+    sock = RecordingSocket(expected=10)
+    transfer = server_module.UdpTransfer(10, 100, 0, False, range(10), 1000, 0)
+    job = server_module.ScheduledUdpTransfer(transfer, ("10.0.0.1", 1001), sock, bandwidth)
+    assert job.send_turn(64, time.perf_counter())
+    assert len(sock.destinations) == 2  # 250 bytes of burst hold two 121-byte datagrams